@@ -1,13 +1,79 @@
-import psycopg2
+import bisect
+import hashlib
+import itertools
+import json
+import re
+import mmap
+import multiprocessing
+import os
+import select
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+try:
+    from psycopg2.extras import execute_values
+except ImportError:
+    execute_values = None
+try:
+    basestring
+except NameError:
+    basestring = str
+
+class EmptyDict(dict):
+    # read-only placeholder shared by every object until its first write replaces it
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        raise TypeError("EmptyDict is read-only")
+
+    def setdefault(self, key, default=None):
+        raise TypeError("EmptyDict is read-only")
+
+    def update(self, *args, **kwargs):
+        raise TypeError("EmptyDict is read-only")
+
+EMPTY = EmptyDict()
+EMPTYSET = frozenset()
+
+@contextmanager
+def unmanaged():
+    yield
+
+def writeBatch(owner):
+    # a change to a role or group of a RoleManager, and the snapshot published for it, are
+    # made inside its batch(), under its writeLock
+    manager = getattr(owner, 'manager', None)
+    return manager.batch() if manager is not None else unmanaged()
 
 class Role(object):
+    __slots__ = ('id', 'name', 'parents', 'children', 'resources', 'is_Login', 'manager', 'policy')
+
     def __init__(self, roleId, roleName, isLogin):
         self.id = roleId
         self.name = roleName
-        self.parents = {}
-        self.parentTree = {}
-        self.resources = {}
+        self.parents = EMPTY
+        self.children = EMPTY
+        self.resources = EMPTY
         self.is_Login = isLogin
+        self.manager = None
+        # snapshot of the parent graph while the role has no manager, see getPolicy
+        self.policy = None
 
     def __str__(self):
         return r'<Role:(id:{0}, name: {1})>'.format(self.id, self.name)
@@ -28,90 +94,196 @@ class Role(object):
     def getParents(self):
         return self.parents
 
+    def getChildren(self):
+        return self.children
+
     def getParentTree(self):
-        self.parentTree.clear()
-        self.__getAllParents(self)
-        return self.parentTree
-
-    def __getAllParents(self, role):
-        for pid, parent in role.getParents().items():
-            if pid == role.getId():
-                self.parentTree[pid] = parent
-            else:
-                self.__getAllParents(parent)
+        # the roles reachable through parent edges, this one included, that list themselves
+        # as a parent; a new dict per call, so concurrent callers never share one. Walked
+        # with a stack and each ancestor visited once, however deep or diamond shaped.
+        parentTree = {}
+        seen = set([self.id])
+        stack = [self]
+        while stack:
+            role = stack.pop()
+            for pid, parent in role.getParents().items():
+                if pid == role.getId():
+                    parentTree[pid] = parent
+                elif pid not in seen:
+                    seen.add(pid)
+                    stack.append(parent)
+        return parentTree
 
     def getAllResources(self):
-        self.parentTree.clear()
-        self.__getAllParents(self)
         dictmerged = {}
         for pId, parent in self.getParentTree().items():
             dictmerged.update(parent.getResources())
         return dictmerged
 
     def addParent(self, parentRoles):
-        if isinstance(parentRoles, Role):
-            if not self.isChildOf(parentRoles):
-                self.parents[parentRoles.getId()] = parentRoles
-                return True
+        with writeBatch(self):
+            if isinstance(parentRoles, Role):
+                if not self.closesCycle(parentRoles):
+                    if self.parents is EMPTY:
+                        self.parents = {}
+                    self.parents[parentRoles.getId()] = parentRoles
+                    if parentRoles is not self:
+                        if parentRoles.children is EMPTY:
+                            parentRoles.children = {}
+                        parentRoles.children[self.id] = self
+                    self.invalidatePermissionIndex()
+                    if self.manager is not None:
+                        self.manager.onParentAdded(self, parentRoles)
+                    self.persist('t_role_memberof', 'INSERT', (self.id, parentRoles.getId()))
+                    return True
+                else:
+                    raise Exception('Error: Cyclic inheritance:(childRole:{0}, ParentRole:{1})'.format(self, parentRoles))
             else:
-                raise Exception('Error: Cyclic inheritance:(childRole:{0}, ParentRole:{1})'.format(self, parentRoles))
-        else:
-            raise TypeError
+                raise TypeError
 
     def removeParent(self, parentRoles):
-        if isinstance(parentRoles, Role):
-            if parentRoles.getId() in self.getParents():
-                del self.parents[parentRoles.getId()]
-                return True
+        with writeBatch(self):
+            if isinstance(parentRoles, Role):
+                if parentRoles.getId() in self.getParents():
+                    del self.parents[parentRoles.getId()]
+                    parentRoles.children.pop(self.id, None)
+                    self.invalidatePermissionIndex()
+                    if self.manager is not None:
+                        self.manager.forgetAncestors(self)
+                    self.persist('t_role_memberof', 'DELETE', (self.id, parentRoles.getId()))
+                    return True
+                else:
+                    return False
             else:
-                return False
-        else:
-            raise TypeError
+                raise TypeError
 
     def addResource(self, res, permissionIds):
-        if isinstance(res, Resource):
-            if not res.getId() in self.getResources():
-                self.resources[res.getId()] = ResPermsPair(res, permissionIds)
-                return True
-        else:
-            raise TypeError("please input the instance of type Resource")
+        with writeBatch(self):
+            if isinstance(res, Resource):
+                if not res.getId() in self.getResources():
+                    if self.resources is EMPTY:
+                        self.resources = {}
+                    self.resources[res.getId()] = ResPermsPair(res, permissionIds, self)
+                    self.invalidatePermissionIndex()
+                    if self.manager is not None:
+                        self.manager.onGrantAdded(self, res)
+                    self.persistGrant('INSERT', self.resources[res.getId()])
+                    return True
+            else:
+                raise TypeError("please input the instance of type Resource")
 
     def isChildOf(self, pRole):
-        if isinstance(pRole, Role):
-            try:
-                roleParents = pRole.getParentTree()
-                if self.getId() in roleParents:
+        metrics = self.manager.metrics if self.manager is not None else None
+        if metrics is not None:
+            return metrics.timed('isChildOf', self.__isChildOf, pRole)
+        return self.__isChildOf(pRole)
+
+    def closesCycle(self, pRole):
+        # a self edge only makes the role hold its own grants, so it is refused only when it
+        # is there already; any other edge closes a cycle when this role is pRole or one of
+        # pRole's ancestors, whether the roles on the way list themselves or not
+        if pRole is self:
+            return self.id in self.parents
+        if pRole.getId() == self.id:
+            return True
+        if pRole.manager is not None:
+            return self.id in pRole.manager.getAncestors(pRole)
+        seen = set()
+        stack = [pRole]
+        while stack:
+            role = stack.pop()
+            for pid, parent in role.getParents().items():
+                if pid == self.id:
                     return True
-                else:
-                    return False
-            except Exception("Error: Inquiry isChildof Child:{0} Parent:{1}".format(self, pRole)) as e:
-                raise e
+                if pid not in seen:
+                    seen.add(pid)
+                    stack.append(parent)
+        return False
+
+    def __isChildOf(self, pRole):
+        # True when this role is in pRole's parent tree: it lists itself as a parent and is
+        # pRole or one of its ancestors, which a RoleManager answers from its closure
+        if isinstance(pRole, Role):
+            if pRole.manager is not None:
+                return self.id in self.parents and (self.id == pRole.getId() or
+                                                    self.id in pRole.manager.getAncestors(pRole))
+            return self.getId() in pRole.getParentTree()
         else:
             raise TypeError("Error: <{0}>.isChildOf".format(self))
 
     def removeResource(self, resource):
-        if isinstance(resource, Resource):
-            if resource.getId() in self.getResources():
-                del self.resources[resource.getId()]
-                return True
-        else:
-            raise TypeError('remove resource need input the Resource instance in role: <{0}>'.format(self))
+        with writeBatch(self):
+            if isinstance(resource, Resource):
+                if resource.getId() in self.getResources():
+                    self.persistGrant('DELETE', self.resources.pop(resource.getId()))
+                    self.invalidatePermissionIndex()
+                    if self.manager is not None:
+                        self.manager.onGrantRemoved(self, resource)
+                    return True
+            else:
+                raise TypeError('remove resource need input the Resource instance in role: <{0}>'.format(self))
 
     def hasPermission(self, resourceId, permission):
-        self.parentTree.clear()
-        self.__getAllParents(self)
-        result = False
-        for pId, pRole in self.parentTree.items():
-            if resourceId in pRole.getResources():
-                result = result or permission in pRole.getResources()[resourceId].getPermissions().values()
-            else:
-                for resId, resPerms in pRole.getResources().items():
-                    if resPerms.getResource().getIsGroup() == 1:
-                        if resourceId in resPerms.getResource().getMembers():
-                            result = result or permission in resPerms.getPermissions().values()
-        return result
+        manager = self.manager
+        if manager is not None and manager.metrics is not None:
+            return manager.metrics.timed('hasPermission', manager.policy.hasPermission, self.id, resourceId,
+                                         permission)
+        return self.getPolicy().hasPermission(self.id, resourceId, permission)
+
+    def getPolicy(self):
+        if self.manager is not None:
+            return self.manager.getPolicy()
+        # a role outside any RoleManager keeps a snapshot of its own parent graph until it
+        # or one of its ancestors changes
+        if self.policy is None:
+            roles = {}
+            stack = [self]
+            while stack:
+                role = stack.pop()
+                if role.getId() not in roles:
+                    roles[role.getId()] = role
+                    stack.extend(role.getParents().values())
+            self.policy = PolicySnapshot.fromRoles(roles.values())
+        return self.policy
+
+    def getPermissionIndex(self):
+        return self.getPolicy().getIndex(self.id)
+
+    def getGrantMasks(self):
+        return dict((resId, resPerms.getMask()) for resId, resPerms in self.resources.items())
+
+    def invalidatePermissionIndex(self):
+        if self.manager is not None:
+            self.manager.onPolicyChange(self)
+            return
+        # the standalone snapshots of this role and everything below it include the change;
+        # a managed role below is reported to its manager, which reads the roles above again
+        seen = set()
+        stack = [self]
+        while stack:
+            role = stack.pop()
+            if role.getId() not in seen:
+                seen.add(role.getId())
+                if role.manager is not None:
+                    role.manager.onPolicyChange(role)
+                    continue
+                role.policy = None
+                stack.extend(role.getChildren().values())
+
+    def persist(self, table, op, row):
+        if self.manager is not None:
+            self.manager.persist(table, op, row)
+
+    def persistGrant(self, op, resPerms, mask=None):
+        # one t_role_permission_resource row per permission in the mask
+        if self.manager is not None:
+            resource = resPerms.getResource()
+            for permId in resource.getResourceType().maskToPermissions(resPerms.getMask() if mask is None else mask):
+                self.manager.persist('t_role_permission_resource', op, (self.id, resource.getId(), permId))
 
 class Resource(object):
+    __slots__ = ('id', 'name', 'resourceType', 'contentId', 'isGroup')
+
     def __init__(self, resId, name, resourceType, contentId, isGroup):
         self.id = resId
         self.name = name
@@ -139,87 +311,137 @@ class Resource(object):
         return self.isGroup
 
 class ResPermsPair(object):
-    def __init__(self, resource, permissionIds):
+    __slots__ = ('resource', 'role', 'mask')
+
+    def __init__(self, resource, permissionIds, role=None):
         if isinstance(resource, Resource):
             self.resource = resource
-            permissions = resource.getResourceType().getPermissions()
-            self.permissions = {}
+            self.role = role
+            resourceType = resource.getResourceType()
             if permissionIds:
+                self.mask = 0
                 for permId in permissionIds:
-                    if permId in permissions:
-                        self.permissions[permId] = permissions[permId]
+                    if permId in resourceType.getPermissions():
+                        self.mask |= resourceType.getPermissionMask(permId)
                     else:
                         raise Exception("ResourceType<{0}> has no permission:<id:{0}>"
-                                        .format(resource.getResourceType().getName(), permId))
+                                        .format(resourceType.getName(), permId))
             else:
-                self.permissions = permissions
+                self.mask = resourceType.getFullMask()
         else:
             raise Exception("ResPermsPair need Resource instance")
 
     def getResource(self):
         return self.resource
 
+    def getMask(self):
+        return self.mask
+
     def getPermissions(self):
-        return self.permissions
+        return self.resource.getResourceType().maskToPermissions(self.mask)
 
     def addPermission(self, permissionId):
-        if permissionId in self.resource.getResourceType().getPermissions():
-            self.permissions[permissionId] = self.resource.getResourceType().getPermissions()[permissionId]
-            return True
-        else:
-            raise Exception("ResourceType<{0}> has no permission:<id:{0}>"
-                                        .format(self.resource.getResourceType().getName(), permissionId))
+        with writeBatch(self.role):
+            resourceType = self.resource.getResourceType()
+            if permissionId in resourceType.getPermissions():
+                self.mask |= resourceType.getPermissionMask(permissionId)
+                if self.role is not None:
+                    self.role.invalidatePermissionIndex()
+                    self.role.persistGrant('INSERT', self, resourceType.getPermissionMask(permissionId))
+                return True
+            else:
+                raise Exception("ResourceType<{0}> has no permission:<id:{0}>"
+                                            .format(resourceType.getName(), permissionId))
 
     def removePermission(self, permissionId):
-        if permissionId in self.permissions:
-            del self.permissions[permissionId]
-            return True
-        else:
-            raise Exception("Resource for current user has no permission<id:{0}>".format(permissionId))
+        with writeBatch(self.role):
+            bit = self.resource.getResourceType().getPermissionMask(permissionId)
+            if self.mask & bit:
+                self.mask &= ~bit
+                if self.role is not None:
+                    self.role.invalidatePermissionIndex()
+                    self.role.persistGrant('DELETE', self, bit)
+                return True
+            else:
+                raise Exception("Resource for current user has no permission<id:{0}>".format(permissionId))
 
 class ResGroup(Resource):
+    __slots__ = ('groupMember', 'manager')
+
     def __init__(self, resourceId, resourceName, resourceType, contentId=None, isGroup=1):
         super(ResGroup, self).__init__(resourceId, resourceName, resourceType, contentId, isGroup)
-        self.groupMember = {}
+        self.groupMember = EMPTY
+        self.manager = None
 
     def addMember(self, resource):
-        if isinstance(resource, Resource):
-            if self.getResourceType() == resource.getResourceType():
-                if resource.getId() not in self.getMembers():
-                    self.groupMember[resource.getId()] = resource
+        with writeBatch(self):
+            if isinstance(resource, Resource):
+                if self.getResourceType() == resource.getResourceType():
+                    if resource.getId() not in self.getMembers():
+                        if isinstance(resource, ResGroup) and (resource is self or self.getId() in resource.getAllMembers()):
+                            raise Exception('Error: Cyclic group membership:(group:{0}, member:{1})'.format(self, resource))
+                        if self.groupMember is EMPTY:
+                            self.groupMember = {}
+                        self.groupMember[resource.getId()] = resource
+                        if self.manager is not None:
+                            self.manager.onGroupMemberAdded(self, resource)
+                else:
+                    raise TypeError("group need a member that have a same resource type")
             else:
-                raise TypeError("group need a member that have a same resource type")
-        else:
-            raise TypeError("group member need a Resource instance")
+                raise TypeError("group member need a Resource instance")
     
     def removeMember(self, resource):
-        if isinstance(resource, Resource):
-            if resource.getId() in self.getMembers():
-                del self.groupMember[resource.getId()]
+        with writeBatch(self):
+            if isinstance(resource, Resource):
+                if resource.getId() in self.getMembers():
+                    del self.groupMember[resource.getId()]
+                    if self.manager is not None:
+                        self.manager.onGroupMemberRemoved(self, resource)
 
     def getMembers(self):
         return self.groupMember
 
+    def getAllMembers(self):
+        # members of nested groups included
+        allMembers = {}
+        stack = [self]
+        while stack:
+            group = stack.pop()
+            for resId, member in group.getMembers().items():
+                if resId not in allMembers:
+                    allMembers[resId] = member
+                    if isinstance(member, ResGroup):
+                        stack.append(member)
+        return allMembers
+
 class ResourceType(object):
+    # each type numbers its own permission names, so a grant mask is read with the bits of
+    # its resource's type; a name keeps its bit when its permission is removed
+    __slots__ = ('id', 'name', 'description', 'permissions', 'permissionMasks', 'permissionBits')
 
     def __init__(self, resourceTypeId, resourceTypeName, description=None):
         self.id = resourceTypeId
         self.name = resourceTypeName
         self.description = description
         self.permissions = {}
+        self.permissionMasks = {}
+        # permission name -> bit
+        self.permissionBits = {}
 
     def __repr__(self):
         return r'ResourceType<Id:{0}, name:{1}, permissions: {2}>'.format(self.id, self.name, self.permissions)
     __str__ = __repr__
 
     def addPermission(self, mapping):
-        for permId, permName in mapping.items():
+        for permId, permName in sorted(mapping.items()):
             if permId not in self.permissions:
                 self.permissions[permId] = permName
+                self.permissionMasks[permId] = self.permissionBits.setdefault(permName, 1 << len(self.permissionBits))
 
     def removePermission(self, permId):
         if permId in self.permissions:
             del self.permissions[permId]
+            del self.permissionMasks[permId]
             return True
         else:
             return False
@@ -227,6 +449,19 @@ class ResourceType(object):
     def getPermissions(self):
         return self.permissions
 
+    def getPermissionMask(self, permId):
+        return self.permissionMasks.get(permId, 0)
+
+    def getFullMask(self):
+        mask = 0
+        for permId, bit in self.permissionMasks.items():
+            mask |= bit
+        return mask
+
+    def maskToPermissions(self, mask):
+        return dict((permId, self.permissions[permId])
+                    for permId, bit in self.permissionMasks.items() if mask & bit)
+
     def getName(self):
         return self.name
 
@@ -236,53 +471,2228 @@ class ResourceType(object):
     def getDesc(self):
         return self.description
 
+class CowDict(object):
+    # Copy-on-write mapping for PolicySnapshot: a base dict shared by every snapshot derived
+    # from it, which is never changed, plus the entries changed since (REMOVED marks a
+    # removed one). derive() copies only those, and folds them into a new base once there
+    # are more than the square root of the base, so a publish costs O(sqrt(n)) amortized
+    # rather than a copy of every entry.
+    __slots__ = ('base', 'delta')
+
+    def __init__(self, base=None, delta=None):
+        self.base = base if base is not None else {}
+        self.delta = delta if delta is not None else {}
+
+    def derive(self):
+        delta = dict(self.delta)
+        if len(delta) > 64 and len(delta) ** 2 > len(self.base):
+            base = dict(self.base)
+            for key, value in delta.items():
+                if value is REMOVED:
+                    base.pop(key, None)
+                else:
+                    base[key] = value
+            return CowDict(base)
+        return CowDict(self.base, delta)
+
+    def get(self, key, default=None):
+        value = self.delta.get(key, self)
+        if value is self:
+            return self.base.get(key, default)
+        return default if value is REMOVED else value
+
+    def __getitem__(self, key):
+        value = self.get(key, REMOVED)
+        if value is REMOVED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.delta[key] = value
+
+    def __contains__(self, key):
+        value = self.delta.get(key, self)
+        if value is self:
+            return key in self.base
+        return value is not REMOVED
+
+    def pop(self, key, default=None):
+        value = self.get(key, REMOVED)
+        if key in self.base:
+            self.delta[key] = REMOVED
+        else:
+            self.delta.pop(key, None)
+        return default if value is REMOVED else value
+
+    def clear(self):
+        self.base = {}
+        self.delta = {}
+
+    def items(self):
+        delta = dict(self.delta)
+        items = [(key, value) for key, value in self.base.items() if key not in delta]
+        items.extend((key, value) for key, value in delta.items() if value is not REMOVED)
+        return items
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def copy(self):
+        return dict(self.items())
+
+# marks an entry removed in a CowDict's delta
+REMOVED = object()
+
+def asCowDict(mapping):
+    if mapping is None:
+        return CowDict()
+    return mapping if isinstance(mapping, CowDict) else CowDict(mapping)
+
+class PolicySnapshot(object):
+    # Immutable view of the policy that permission checks read without taking a lock.
+    # RoleManager publishes a new snapshot after every change (or batch of changes); the
+    # only thing filled in later is the per-role effective index cache, and that is derived
+    # from the snapshot's own data, so concurrent fills agree. The maps are CowDicts (a
+    # plain dict passed in becomes the base of one, and must not be changed afterwards).
+    def __init__(self, generation=0, parents=None, grants=None, groupsOf=None, indexes=None, resourceBits=None):
+        self.generation = generation
+        # roleId -> tuple of parent ids, the role's own id included when it lists itself
+        self.parents = asCowDict(parents)
+        # roleId -> {resourceId: mask} of the role's own grants
+        self.grants = asCowDict(grants)
+        # resourceId -> frozenset of the groups holding it, nested groups included
+        self.groupsOf = asCowDict(groupsOf)
+        # roleId -> {resourceId: mask} granted by the role's whole parent tree
+        self.indexes = asCowDict(indexes)
+        # resourceId -> permission name -> bit of its type, for the resources granted or
+        # held by a group
+        self.resourceBits = asCowDict(resourceBits)
+        self.bitset = None
+        self.inverted = None
+        # what decision cache answers computed from this policy are filed under, set by
+        # RoleManager.versionPolicy
+        self.version = None
+
+    @classmethod
+    def fromRoles(cls, roles):
+        parents = {}
+        grants = {}
+        groupsOf = {}
+        resourceBits = {}
+        for role in roles:
+            parents[role.getId()] = tuple(role.getParents())
+            grants[role.getId()] = role.getGrantMasks()
+            for resId, resPerms in role.getResources().items():
+                resourceBits[resId] = resPerms.getResource().getResourceType().permissionBits
+                if isinstance(resPerms.getResource(), ResGroup):
+                    for memberId, member in resPerms.getResource().getAllMembers().items():
+                        groupsOf.setdefault(memberId, set()).add(resId)
+                        resourceBits[memberId] = member.getResourceType().permissionBits
+        return cls(0, parents, grants, groupsOf, resourceBits=resourceBits)
+
+    def getPermissionBit(self, resourceId, permission):
+        return self.resourceBits.get(resourceId, EMPTY).get(permission, 0)
+
+    def hasPermission(self, roleId, resourceId, permission):
+        # the CowDict lookups are spelled out here, this being the hot path
+        bits = self.resourceBits.delta.get(resourceId)
+        if bits is None:
+            bits = self.resourceBits.base.get(resourceId)
+        if bits is None or bits is REMOVED:
+            return False
+        bit = bits.get(permission)
+        if bit is None:
+            return False
+        index = self.indexes.delta.get(roleId)
+        if index is None:
+            index = self.indexes.base.get(roleId)
+        if index is None or index is REMOVED:
+            if roleId not in self.parents:
+                return False
+            index = self.__buildIndex(roleId)
+        if index.get(resourceId, 0) & bit:
+            return True
+        groupIds = self.groupsOf.delta.get(resourceId)
+        if groupIds is None:
+            groupIds = self.groupsOf.base.get(resourceId)
+        if groupIds is not None and groupIds is not REMOVED:
+            for groupId in groupIds:
+                if index.get(groupId, 0) & bit:
+                    return True
+        return False
+
+    def getIndex(self, roleId):
+        index = self.indexes.get(roleId)
+        if index is None:
+            index = self.__buildIndex(roleId)
+        return index
+
+    def __buildIndex(self, roleId):
+        indexes = self.indexes
+        stack = [roleId]
+        visiting = set()
+        while stack:
+            rid = stack[-1]
+            if rid in indexes:
+                stack.pop()
+                continue
+            pending = [pid for pid in self.parents.get(rid, ()) if pid != rid and pid not in indexes]
+            if pending:
+                visiting.add(rid)
+                for pid in pending:
+                    if pid in visiting:
+                        raise Exception('Error: Cyclic inheritance:(childRole:{0}, ParentRole:{1})'.format(rid, pid))
+                stack.extend(pending)
+            else:
+                stack.pop()
+                visiting.discard(rid)
+                indexes[rid] = self.__mergeIndex(rid)
+        return indexes[roleId]
+
+    def __mergeIndex(self, roleId):
+        # same tree as Role.getParentTree: the role itself when it lists itself as a parent,
+        # plus the trees of its other parents, whose indexes are already built
+        parentIds = self.parents.get(roleId, ())
+        inherited = [self.indexes[pid] for pid in parentIds if pid != roleId]
+        local = self.grants.get(roleId) if roleId in parentIds else None
+        if not local and len(inherited) == 1:
+            return inherited[0]
+        merged = dict(local) if local else {}
+        for index in inherited:
+            if not merged:
+                merged = dict(index)
+                continue
+            for resId, mask in index.items():
+                merged[resId] = merged.get(resId, 0) | mask
+        return merged
+
+    def getBitset(self):
+        if self.bitset is None:
+            self.bitset = PermissionBitset(self)
+        return self.bitset
+
+    def getInverted(self):
+        # (grantees, children, members), CowDicts built on first use or carried over from
+        # the previous snapshot by inheritInverted:
+        #   grantees: resourceId -> {roleId: mask} of own grants that count for the role
+        #             itself, i.e. of roles listing themselves as a parent
+        #   children: roleId -> frozenset of the roles inheriting its parent tree
+        #   members:  groupId -> frozenset of its members, nested groups included
+        if self.inverted is None:
+            grantees = {}
+            children = {}
+            for roleId, parentIds in self.parents.items():
+                for pid in parentIds:
+                    if pid != roleId:
+                        children.setdefault(pid, set()).add(roleId)
+                    else:
+                        for resId, mask in self.grants.get(roleId, {}).items():
+                            grantees.setdefault(resId, {})[roleId] = mask
+            members = {}
+            for memberId, groupIds in self.groupsOf.items():
+                for groupId in groupIds:
+                    members.setdefault(groupId, set()).add(memberId)
+            self.inverted = (CowDict(grantees),
+                             CowDict(dict((pid, frozenset(ids)) for pid, ids in children.items())),
+                             CowDict(dict((groupId, frozenset(ids)) for groupId, ids in members.items())))
+        return self.inverted
+
+    def inheritInverted(self, old, roleIds, resourceIds):
+        # old's inverted indexes, if it has them, with only the entries of the given roles
+        # and of the groups of the given resources rewritten; resourceIds None means any
+        # membership may have changed, and the indexes are left to be built on first use
+        inverted = old.inverted
+        if inverted is None or resourceIds is None:
+            return
+        grantees, children, members = [index.derive() for index in inverted]
+        for rid in roleIds:
+            oldParents = old.parents.get(rid, ())
+            newParents = self.parents.get(rid, ())
+            oldGrants = old.grants.get(rid, EMPTY) if rid in oldParents else EMPTY
+            newGrants = self.grants.get(rid, EMPTY) if rid in newParents else EMPTY
+            for resId in set(oldGrants) | set(newGrants):
+                mask = newGrants.get(resId)
+                if mask != oldGrants.get(resId):
+                    entry = dict(grantees.get(resId, EMPTY))
+                    if mask is None:
+                        entry.pop(rid, None)
+                    else:
+                        entry[rid] = mask
+                    if entry:
+                        grantees[resId] = entry
+                    else:
+                        grantees.pop(resId, None)
+            for pid in set(oldParents) ^ set(newParents):
+                if pid != rid:
+                    if pid in newParents:
+                        entry = children.get(pid, EMPTYSET) | frozenset([rid])
+                    else:
+                        entry = children.get(pid, EMPTYSET) - frozenset([rid])
+                    if entry:
+                        children[pid] = entry
+                    else:
+                        children.pop(pid, None)
+        for resId in resourceIds:
+            oldGroups = old.groupsOf.get(resId, EMPTYSET)
+            newGroups = self.groupsOf.get(resId, EMPTYSET)
+            for groupId in set(oldGroups) ^ set(newGroups):
+                if groupId in newGroups:
+                    entry = members.get(groupId, EMPTYSET) | frozenset([resId])
+                else:
+                    entry = members.get(groupId, EMPTYSET) - frozenset([resId])
+                if entry:
+                    members[groupId] = entry
+                else:
+                    members.pop(groupId, None)
+        self.inverted = (grantees, children, members)
+
+    def accessibleResources(self, roleId, permission):
+        # ids of the resources roleId has permission on, group grants expanded, each once
+        if roleId not in self.parents:
+            return
+        granted = set(resId for resId, mask in self.getIndex(roleId).items()
+                      if mask & self.getPermissionBit(resId, permission))
+        members = self.getInverted()[2]
+        for resId in sorted(granted):
+            yield resId
+            for memberId in sorted(members.get(resId, ())):
+                # a member granted itself, or through a lower numbered group, came out already
+                if memberId not in granted and min(self.groupsOf[memberId] & granted) == resId:
+                    yield memberId
+
+    def rolesWithAccess(self, resourceId, permission):
+        # ids of the roles with permission on resourceId: the roles granting it to themselves,
+        # directly or through one of its groups, and everything inheriting from them; the
+        # groups have the resource's type, and so its bits
+        bit = self.getPermissionBit(resourceId, permission)
+        if not bit:
+            return
+        grantees, children = self.getInverted()[:2]
+        seen = set()
+        for target in [resourceId] + sorted(self.groupsOf.get(resourceId, ())):
+            for roleId, mask in grantees.get(target, EMPTY).items():
+                if mask & bit and roleId not in seen:
+                    seen.add(roleId)
+                    stack = [roleId]
+                    while stack:
+                        rid = stack.pop()
+                        yield rid
+                        for childId in children.get(rid, ()):
+                            if childId not in seen:
+                                seen.add(childId)
+                                stack.append(childId)
+
+def paginate(items, pageSize):
+    # lists of at most pageSize items, produced as items are
+    page = []
+    for item in items:
+        page.append(item)
+        if len(page) >= pageSize:
+            yield page
+            page = []
+    if page:
+        yield page
+
+# state of an exportPolicy worker process, set up once by initExportWorker
+exportState = {}
+# per-role indexes an export worker keeps between chunks before starting over
+exportIndexLimit = 50000
+
+def initExportWorker(parents, grants, groupsOf, resourceBits):
+    # with fork the tables are shared with the parent; other start methods pickle them once
+    # per worker, the bits of each resource type as one object
+    exportState["policy"] = PolicySnapshot(0, parents, grants, groupsOf, resourceBits=resourceBits)
+    # id of a type's bits -> [(bit, CSV name)] in bit order
+    exportState["names"] = {}
+
+def exportChunk(roleIds):
+    # CSV rows of every effective (role, resource, permission) of the given roles
+    policy = exportState["policy"]
+    namesOf = exportState["names"]
+    members = policy.getInverted()[2]
+    lines = []
+    for roleId in roleIds:
+        index = policy.getIndex(roleId)
+        effective = dict(index)
+        for resId, mask in index.items():
+            for memberId in members.get(resId, ()):
+                effective[memberId] = effective.get(memberId, 0) | mask
+        for resId in sorted(effective):
+            mask = effective[resId]
+            bits = policy.resourceBits.get(resId, EMPTY)
+            names = namesOf.get(id(bits))
+            if names is None:
+                names = namesOf[id(bits)] = [(bit, csvField(name)) for name, bit in
+                                             sorted(bits.items(), key=lambda item: item[1])]
+            for bit, name in names:
+                if mask & bit:
+                    lines.append('{0},{1},{2}\n'.format(roleId, resId, name))
+    if len(policy.indexes) > exportIndexLimit:
+        policy.indexes.clear()
+    return len(roleIds), len(lines), ''.join(lines)
+
+def csvField(text):
+    if any(c in text for c in ',"\r\n'):
+        return '"{0}"'.format(text.replace('"', '""'))
+    return text
+
+class PermissionBitset(object):
+    # per role, the resource ids of its index as a sorted int64 array with the matching
+    # permission masks; a row is built on first use and carried over to later snapshots
+    # until the role's index is dropped (see publishPolicy). Group grants are expanded
+    # when checking, through the groups holding each resource, as hasPermission does.
+    def __init__(self, policy, rows=None):
+        self.policy = policy
+        self.rows = asCowDict(rows)
+
+    def getRow(self, roleId):
+        row = self.rows.get(roleId)
+        if row is None and roleId in self.policy.parents:
+            index = self.policy.getIndex(roleId)
+            resIds = sorted(resId for resId, mask in index.items() if mask)
+            masks = [index[resId] for resId in resIds]
+            # past 64 names in one resource type the masks no longer fit a uint64
+            dtype = numpy.uint64 if max(masks or [0]) < 1 << 64 else object
+            row = self.rows[roleId] = (numpy.array(resIds, dtype=numpy.int64), numpy.array(masks, dtype=dtype))
+        return row
+
+    def check(self, roleIds, resourceIds, wantedBits):
+        result = numpy.zeros((len(roleIds), len(resourceIds)), dtype=bool)
+        rows = [(i, self.getRow(roleId)) for i, roleId in enumerate(roleIds)]
+        rows = [(i, row) for i, row in rows if row is not None and len(row[0])]
+        if not rows or not result.size:
+            return result
+        # each resource is looked up under its own id and those of the groups holding it
+        targets = []
+        starts = []
+        for resId in resourceIds:
+            starts.append(len(targets))
+            targets.append(resId)
+            targets.extend(self.policy.groupsOf.get(resId, ()))
+        columns, targetCols = numpy.unique(numpy.array(targets, dtype=numpy.int64), return_inverse=True)
+        # the rows' masks scattered into a roles x columns matrix
+        rowIds = numpy.repeat([i for i, row in rows], [len(row[0]) for i, row in rows])
+        resIds = numpy.concatenate([row[0] for i, row in rows])
+        masks = numpy.concatenate([row[1] for i, row in rows])
+        pos = numpy.minimum(numpy.searchsorted(columns, resIds), len(columns) - 1)
+        found = columns[pos] == resIds
+        matrix = numpy.zeros((len(roleIds), len(columns)), dtype=masks.dtype)
+        matrix[rowIds[found], pos[found]] = masks[found]
+        owners = numpy.repeat(numpy.arange(len(starts)), numpy.diff(starts + [len(targets)]))
+        if masks.dtype == object:
+            wanted = numpy.array(wantedBits, dtype=object)[owners]
+        else:
+            # bits past 64 cannot be set in a uint64 mask
+            wanted = numpy.array([bit if bit < 1 << 64 else 0 for bit in wantedBits], dtype=numpy.uint64)[owners]
+        hits = (matrix[:, targetCols] & wanted) != 0
+        return numpy.logical_or.reduceat(hits, starts, axis=1)
+
+# column order of the row tuples the change feed applies; dict rows, as sent by
+# row_to_json, are put back into this order
+changeColumns = {
+    't_permission': ('id', 'name', 'description', 'resource_type_id'),
+    't_resource_type': ('id', 'name', 'description'),
+    't_resource': ('id', 'name', 'resource_type_id', 'content_id', 'is_group'),
+    't_role': ('id', 'name', 'is_login'),
+    't_role_memberof': ('child_role_id', 'parent_role_id'),
+    't_group_resource': ('group_id', 'resource_id'),
+    't_role_permission_resource': ('role_id', 'resource_id', 'permission_id'),
+}
+
+# A change source has poll(timeout) returning a list of (table, op, row, oldRow) events,
+# op being INSERT, UPDATE or DELETE and oldRow only set for UPDATE. One whose events are
+# numbered the same for every worker reading it also has getPosition(), naming how far
+# the events returned so far go.
+
+class QueueChangeSource(object):
+    # in-process source: whoever changes the tables pushes the same rows here
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def push(self, table, op, row, oldRow=None):
+        self.queue.put((table, op, row, oldRow))
+
+    def poll(self, timeout):
+        events = []
+        try:
+            events.append(self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait())
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+class PgNotifySource(object):
+    # LISTEN/NOTIFY on a dedicated autocommit connection, fed by installTriggers()
+    triggerSql = '''
+        CREATE OR REPLACE FUNCTION rms_notify_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify(TG_ARGV[0], json_build_object(
+                    'table', TG_TABLE_NAME, 'op', TG_OP, 'row', row_to_json(OLD))::text);
+                RETURN OLD;
+            END IF;
+            PERFORM pg_notify(TG_ARGV[0], json_build_object(
+                'table', TG_TABLE_NAME, 'op', TG_OP, 'row', row_to_json(NEW),
+                'old', CASE WHEN TG_OP = 'UPDATE' THEN row_to_json(OLD) END)::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;'''
+
+    def __init__(self, db, channel='rms_change'):
+        self.db = db
+        self.channel = channel
+        # notifications only reach a connection outside a transaction
+        self.db.autocommit = True
+        cur = self.db.cursor()
+        try:
+            cur.execute('''LISTEN {0};'''.format(channel))
+        finally:
+            cur.close()
+
+    def installTriggers(self):
+        cur = self.db.cursor()
+        try:
+            cur.execute(self.triggerSql)
+            for table in sorted(changeColumns):
+                cur.execute('''DROP TRIGGER IF EXISTS rms_change ON {0};'''.format(table))
+                cur.execute('''CREATE TRIGGER rms_change AFTER INSERT OR UPDATE OR DELETE ON {0}
+                               FOR EACH ROW EXECUTE PROCEDURE rms_notify_change('{1}');'''.format(table, self.channel))
+        finally:
+            cur.close()
+
+    def poll(self, timeout):
+        if select.select([self.db], [], [], timeout) == ([], [], []):
+            return []
+        self.db.poll()
+        events = []
+        while self.db.notifies:
+            payload = json.loads(self.db.notifies.pop(0).payload)
+            events.append((payload["table"], payload["op"], payload["row"], payload.get("old")))
+        return events
+
+class ChangeLogSource(object):
+    # polls a change-log table (id serial, table_name, op, row_data json, old_data json)
+    # filled by triggers, for setups where NOTIFY is not available
+    def __init__(self, db, table='t_change_log', lastId=0, batchSize=10000):
+        self.db = db
+        self.table = table
+        self.lastId = lastId
+        self.batchSize = batchSize
+
+    def poll(self, timeout):
+        cur = self.db.cursor()
+        try:
+            sql = '''SELECT id, table_name, op, row_data, old_data FROM {0}
+                     WHERE id > {1} ORDER BY id LIMIT {2}'''.format(self.table, self.lastId, self.batchSize)
+            cur.execute(sql)
+            rows = cur.fetchall()
+            self.db.commit()
+        finally:
+            cur.close()
+        if not rows:
+            time.sleep(timeout)
+            return []
+        self.lastId = rows[-1][0]
+        events = []
+        for logId, table, op, row, oldRow in rows:
+            if isinstance(row, basestring):
+                row = json.loads(row)
+            if isinstance(oldRow, basestring):
+                oldRow = json.loads(oldRow)
+            events.append((table, op, row, oldRow))
+        return events
+
+    def getPosition(self):
+        return 'log:{0}:{1}'.format(self.table, self.lastId)
+
+class DecisionCache(object):
+    # hasPermission answers shared through redis by every worker, with an in-process LRU
+    # in front. Keys carry the version of the policy an answer was computed from (see
+    # RoleManager.versionPolicy): workers holding the same policy share answers, and one
+    # still holding an older one neither reads nor files answers under the newer version.
+    # A change therefore needs no invalidation; the keys of past versions expire after ttl.
+    mgetChunk = 1000
+
+    def __init__(self, redisdb, prefix='RMSDecision', lruSize=100000, ttl=3600):
+        self.redisdb = redisdb
+        self.prefix = prefix
+        self.lruSize = lruSize
+        self.ttl = ttl
+        # (version, check) -> decision
+        self.lru = OrderedDict()
+        # readers check concurrently: every access to the LRU is made under this lock
+        self.lock = threading.Lock()
+        self.stats = {"lruHits": 0, "redisHits": 0, "misses": 0}
+
+    def getStats(self):
+        return dict(self.stats)
+
+    def key(self, version, check):
+        return '{0}:{1}:{2}:{3}:{4}'.format(self.prefix, version, check[0], check[1], check[2])
+
+    def remember(self, version, checks, decisions):
+        with self.lock:
+            for check, decision in zip(checks, decisions):
+                self.lru[version, check] = decision
+                if len(self.lru) > self.lruSize:
+                    self.lru.popitem(last=False)
+
+    def getMany(self, checks, version):
+        # checks are (roleId, resourceId, permission) tuples; None marks a miss
+        results = [None] * len(checks)
+        missing = []
+        with self.lock:
+            for i, check in enumerate(checks):
+                decision = self.lru.pop((version, check), None)
+                if decision is None:
+                    missing.append(i)
+                else:
+                    self.lru[version, check] = decision
+                    results[i] = decision
+                    self.stats["lruHits"] += 1
+        if missing:
+            pipe = self.redisdb.pipeline(transaction=False)
+            for start in range(0, len(missing), self.mgetChunk):
+                pipe.mget([self.key(version, checks[i]) for i in missing[start:start + self.mgetChunk]])
+            values = [value for chunk in pipe.execute() for value in chunk]
+            hits = []
+            for i, value in zip(missing, values):
+                if value is None:
+                    self.stats["misses"] += 1
+                else:
+                    results[i] = value in (b'1', '1')
+                    hits.append(i)
+                    self.stats["redisHits"] += 1
+            self.remember(version, [checks[i] for i in hits], [results[i] for i in hits])
+        return results
+
+    def setMany(self, checks, decisions, version):
+        # version is that of the policy the decisions were computed from
+        pipe = self.redisdb.pipeline(transaction=False)
+        for check, decision in zip(checks, decisions):
+            pipe.set(self.key(version, check), '1' if decision else '0', ex=self.ttl)
+        pipe.execute()
+        self.remember(version, checks, decisions)
+
+class Metrics(object):
+    # Call counters and latency histograms for one RoleManager. Nothing is allocated or
+    # timed until RoleManager.enableMetrics(); until then each hook is one attribute test.
+    buckets = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2, 0.1, 1.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, label) -> count
+        self.counters = {}
+        # name -> [per-bucket counts (the last one +Inf), sum of seconds]
+        self.histograms = {}
+
+    def count(self, name, label=None, n=1):
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    def timed(self, name, func, *args):
+        startTime = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.observe(name, time.time() - startTime)
+
+    def getStats(self):
+        with self.lock:
+            counters = {}
+            for (name, label), value in self.counters.items():
+                if label is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[label] = value
+            histograms = {}
+            for name, (counts, total) in self.histograms.items():
+                histograms[name] = {"count": sum(counts), "sumSeconds": total,
+                                    "buckets": dict(zip([str(le) for le in self.buckets] + ['+Inf'], counts))}
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheusLines(self, prefix):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((name, (list(counts), total)) for name, (counts, total) in self.histograms.items())
+        for name, items in itertools.groupby(counters, key=lambda item: item[0][0]):
+            metric = '{0}_{1}_total'.format(prefix, metricName(name))
+            lines.append('# TYPE {0} counter'.format(metric))
+            for (name, label), value in items:
+                lines.append('{0}{1} {2}'.format(metric, '' if label is None else '{{op="{0}"}}'.format(label), value))
+        for name, (counts, total) in histograms:
+            metric = '{0}_{1}_seconds'.format(prefix, metricName(name))
+            lines.append('# TYPE {0} histogram'.format(metric))
+            cumulative = 0
+            for le, count in zip([repr(le) for le in self.buckets] + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, le, cumulative))
+            lines.append('{0}_sum {1!r}'.format(metric, total))
+            lines.append('{0}_count {1}'.format(metric, cumulative))
+        return lines
+
+def metricName(name):
+    # hasPermission -> has_permission
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+class WriteBehind(object):
+    # Queues the policy mutations made through a RoleManager and writes them out in
+    # batches: one pipelined round trip for the redis ResourceTable hash, and one
+    # statement per run of same-table same-op rows for Postgres (multi-row INSERT through
+    # psycopg2.extras.execute_values when available, executemany otherwise).
+    # Rows are (table, op, row) with row in changeColumns order; ResourceTable entries are
+    # ('ResourceTable', 'HSET' | 'HDEL', (name, resourceId)).
+    # Entries of a batch that fails are retried one at a time on later flushes, so a bad row
+    # cannot hold back the others; after maxRetries failures they go to deadLetters. One
+    # stops being retried as soon as a newer entry for the same row is queued. Past
+    # maxPending queued entries the writers flush themselves, and the oldest entries are
+    # dropped to deadLetters if that fails as well.
+    linkTables = ('t_role_memberof', 't_group_resource', 't_role_permission_resource')
+
+    def __init__(self, db, redisdb, flushInterval=1.0, flushSize=10000, maxRetries=5, maxPending=1000000):
+        self.db = db
+        self.redisdb = redisdb
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.maxRetries = maxRetries
+        self.maxPending = maxPending
+        self.pending = []
+        # [(failures, entry)], oldest first
+        self.retrying = []
+        self.deadLetters = deque(maxlen=maxPending)
+        self.lastError = None
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.stats = {"flushes": 0, "rows": 0, "redisWrites": 0, "failures": 0, "dropped": 0, "superseded": 0}
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        if flushInterval:
+            self.thread = threading.Thread(target=self.flushLoop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def getStats(self):
+        return dict(self.stats, pending=len(self.pending) + len(self.retrying))
+
+    def key(self, entry):
+        # what an entry writes: a link row, an entity id or a ResourceTable field
+        table, op, row = entry
+        return table, tuple(row) if table in self.linkTables else row[0]
+
+    def add(self, table, op, row):
+        with self.lock:
+            self.pending.append((table, op, row))
+            full = len(self.pending) >= self.flushSize
+            overflow = len(self.pending) + len(self.retrying) >= self.maxPending
+        if overflow:
+            if not self.flush():
+                self.shed()
+        elif full:
+            if self.thread is not None:
+                self.wake.set()
+            else:
+                self.flush()
+
+    def shed(self):
+        with self.lock:
+            excess = len(self.pending) + len(self.retrying) - self.maxPending
+            if excess <= 0:
+                return
+            dropped = [entry for failures, entry in self.retrying[:excess]]
+            del self.retrying[:excess]
+            rest = excess - len(dropped)
+            dropped.extend(self.pending[:rest])
+            del self.pending[:rest]
+        self.deadLetters.extend(dropped)
+        self.stats["dropped"] += len(dropped)
+        print 'Error: write behind queue full, {0} entries dropped'.format(len(dropped))
+
+    def flushLoop(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.flushInterval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                entries, self.pending = self.pending, []
+                retrying, self.retrying = self.retrying, []
+            # the newest entry for a row is what it has to end up as: writing an older one
+            # after it would undo it, so a retry is dropped once a newer one is queued, and
+            # none that is kept has a later entry for its row to be held back
+            newer = set(self.key(entry) for entry in entries)
+            kept = []
+            for failures, entry in reversed(retrying):
+                key = self.key(entry)
+                if key in newer:
+                    self.stats["superseded"] += 1
+                else:
+                    newer.add(key)
+                    kept.append((failures, entry))
+            retrying = kept[::-1]
+            if not entries and not retrying:
+                return True
+            # both writes are idempotent, so a failed entry is simply written again
+            failed = [(failures + 1, entry) for failures, entry in retrying if not self.write([entry])]
+            if entries and not self.write(entries):
+                failed.extend((1, entry) for entry in entries)
+            if not failed:
+                self.stats["flushes"] += 1
+                return True
+            self.stats["failures"] += 1
+            kept = [(failures, entry) for failures, entry in failed if failures < self.maxRetries]
+            dead = [entry for failures, entry in failed if failures >= self.maxRetries]
+            self.deadLetters.extend(dead)
+            self.stats["dropped"] += len(dead)
+            with self.lock:
+                self.retrying[:0] = kept
+            print 'Error: write behind flush failed for {0} entries, {1} dropped: {2}'.format(
+                len(failed), len(dead), self.lastError)
+            return False
+
+    def write(self, entries):
+        try:
+            names = [entry for entry in entries if entry[0] == 'ResourceTable']
+            rows = [entry for entry in entries if entry[0] != 'ResourceTable']
+            if names:
+                self.writeNames(names)
+            if rows:
+                self.writeRows(rows)
+            self.stats["rows"] += len(rows)
+            self.stats["redisWrites"] += len(names)
+            return True
+        except Exception as e:
+            self.lastError = e
+            return False
+
+    def writeNames(self, names):
+        pipe = self.redisdb.pipeline(transaction=False)
+        for table, op, (name, resId) in names:
+            if op == 'HSET':
+                pipe.hset('ResourceTable', name, resId)
+            else:
+                pipe.hdel('ResourceTable', name)
+        pipe.execute()
+
+    def writeRows(self, rows):
+        cur = self.db.cursor()
+        try:
+            for (table, op), run in itertools.groupby(rows, key=lambda entry: entry[:2]):
+                values = [entry[2] for entry in run]
+                columns = changeColumns[table]
+                if op == 'INSERT':
+                    sql = 'INSERT INTO {0} ({1}) VALUES {2} ON CONFLICT DO NOTHING'
+                    if execute_values is not None:
+                        execute_values(cur, sql.format(table, ', '.join(columns), '%s'), values,
+                                       page_size=self.flushSize)
+                    else:
+                        placeholders = '({0})'.format(', '.join(['%s'] * len(columns)))
+                        cur.executemany(sql.format(table, ', '.join(columns), placeholders), values)
+                elif table in self.linkTables:
+                    where = ' AND '.join('{0}=%s'.format(column) for column in columns)
+                    cur.executemany('DELETE FROM {0} WHERE {1}'.format(table, where), values)
+                else:
+                    cur.execute('DELETE FROM {0} WHERE {1} = ANY(%s)'.format(table, columns[0]),
+                                ([row[0] for row in values],))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def close(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.flush()
+
+class MappedPolicy(object):
+    # Read-only policy answering hasPermission straight from a file written by
+    # RoleManager.saveMappedPolicy. The file is mapped, not parsed: forked workers share
+    # its pages and no per-role Python objects exist for refcounting to dirty.
+    # Sections are little-endian int64 arrays (grant masks unsigned):
+    #   roleIds (sorted), treeOffsets/treeRows: per role, the rows whose grants apply
+    #   (getParentTree), grantOffsets/grantResIds/grantMasks: per role, its own grants
+    #   sorted by resource, memberIds (sorted)/groupOffsets/groupIds: the groups holding
+    #   a resource, nested groups included, resourceIds (sorted)/resourceTypeIds: the type
+    #   of each resource; names is a JSON resource type id -> permission name -> bit map.
+    magic = b'RMSMMAP\0'
+    version = 2
+    sectionNames = ('roleIds', 'treeOffsets', 'treeRows', 'grantOffsets', 'grantResIds', 'grantMasks',
+                    'memberIds', 'groupOffsets', 'groupIds', 'resourceIds', 'resourceTypeIds', 'names')
+    header = struct.Struct('<8sII')
+    sectionHeader = struct.Struct('<QQ')
+    int64 = struct.Struct('<q')
+    uint64 = struct.Struct('<Q')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nSections = self.header.unpack_from(self.mm, 0)
+        if magic != self.magic or version != self.version or nSections != len(self.sectionNames):
+            self.mm.close()
+            raise Exception('Error: {0} is not a version {1} RMS policy map'.format(path, self.version))
+        self.sections = {}
+        for i, name in enumerate(self.sectionNames):
+            self.sections[name] = self.sectionHeader.unpack_from(self.mm, self.header.size + i * self.sectionHeader.size)
+        offset, length = self.sections['names']
+        self.permissionBits = dict((int(rtId), bits) for rtId, bits in
+                                   json.loads(self.mm[offset:offset + length].decode('utf-8')).items())
+        self.nRoles = self.sections['roleIds'][1]
+        self.nMembers = self.sections['memberIds'][1]
+        self.nResources = self.sections['resourceIds'][1]
+
+    def close(self):
+        self.mm.close()
+
+    def item(self, section, i):
+        return self.int64.unpack_from(self.mm, self.sections[section][0] + 8 * i)[0]
+
+    def search(self, section, lo, hi, value):
+        offset = self.sections[section][0]
+        unpack = self.int64.unpack_from
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = unpack(self.mm, offset + 8 * mid)[0]
+            if found < value:
+                lo = mid + 1
+            elif found > value:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def hasPermission(self, roleId, resourceId, permission):
+        resource = self.search('resourceIds', 0, self.nResources, resourceId)
+        if resource < 0:
+            return False
+        bit = self.permissionBits.get(self.item('resourceTypeIds', resource), EMPTY).get(permission)
+        row = self.search('roleIds', 0, self.nRoles, roleId)
+        if not bit or row < 0:
+            return False
+        resourceIds = [resourceId]
+        member = self.search('memberIds', 0, self.nMembers, resourceId)
+        if member >= 0:
+            resourceIds.extend(self.item('groupIds', i) for i in
+                               range(self.item('groupOffsets', member), self.item('groupOffsets', member + 1)))
+        masksOffset = self.sections['grantMasks'][0]
+        for i in range(self.item('treeOffsets', row), self.item('treeOffsets', row + 1)):
+            pRow = self.item('treeRows', i)
+            lo = self.item('grantOffsets', pRow)
+            hi = self.item('grantOffsets', pRow + 1)
+            for resId in resourceIds:
+                grant = self.search('grantResIds', lo, hi, resId)
+                if grant >= 0 and self.uint64.unpack_from(self.mm, masksOffset + 8 * grant)[0] & bit:
+                    return True
+        return False
+
+class LazyRoles(object):
+    # allRoles of a lazy RoleManager: a bounded LRU of the roles loaded so far. Reading a
+    # role that is not loaded (get, []) loads it with its ancestors and grants; "in", len()
+    # and iteration only see what is loaded. Past maxRoles the least recently used roles
+    # without loaded children are unloaded, then the ancestors left without any, so
+    # ancestors of loaded roles always stay. Ids found in no table are remembered, up to
+    # maxMissing of them, so looking them up again costs no query. Roles pinned by a check
+    # in flight are never evicted.
+    def __init__(self, manager, maxRoles=10000, maxMissing=None):
+        self.manager = manager
+        self.maxRoles = maxRoles
+        self.maxMissing = maxRoles if maxMissing is None else maxMissing
+        self.roles = OrderedDict()
+        self.missing = OrderedDict()
+        # roleId -> checks in flight that need it
+        self.pins = {}
+        self.lock = threading.RLock()
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0, "misses": 0}
+
+    def getStats(self):
+        return dict(self.stats, loaded=len(self.roles))
+
+    def __getitem__(self, roleId):
+        role = self.get(roleId)
+        if role is None:
+            raise KeyError(roleId)
+        return role
+
+    def get(self, roleId, default=None):
+        with self.lock:
+            role = self.roles.pop(roleId, None)
+            if role is not None:
+                self.roles[roleId] = role
+                self.stats["hits"] += 1
+                return role
+            if roleId in self.missing:
+                self.stats["misses"] += 1
+                return default
+        self.ensure([roleId])
+        return self.roles.get(roleId, default)
+
+    def ensure(self, roleIds):
+        # load whichever of roleIds are missing, with one set of queries for all of them.
+        # A role another thread is loading is in self.roles before its batch is published,
+        # so what counts as loaded is what the policy holds
+        policy = self.manager.policy
+        with self.lock:
+            missing = [roleId for roleId in roleIds if roleId not in policy.parents and roleId not in self.missing]
+        if missing:
+            self.stats["loads"] += 1
+            self.manager.loadRoles(missing)
+            with self.lock:
+                for roleId in missing:
+                    if roleId not in self.roles:
+                        self.missing[roleId] = True
+                while len(self.missing) > self.maxMissing:
+                    self.missing.popitem(last=False)
+            self.evict(set(roleIds))
+
+    @contextmanager
+    def pinned(self, roleIds):
+        # load roleIds and keep them, with their ancestors, loaded until the block ends
+        roleIds = list(roleIds)
+        with self.lock:
+            for roleId in roleIds:
+                self.pins[roleId] = self.pins.get(roleId, 0) + 1
+        try:
+            self.ensure(roleIds)
+            yield
+        finally:
+            with self.lock:
+                for roleId in roleIds:
+                    count = self.pins.pop(roleId) - 1
+                    if count:
+                        self.pins[roleId] = count
+
+    def forgetMissing(self, roleId):
+        # the role was created since a lookup missed it
+        with self.lock:
+            self.missing.pop(roleId, None)
+
+    def evict(self, keep=()):
+        # victims are picked and unloaded, and the policy without them published, under one
+        # hold of the writeLock and self.lock (in that order, as loadRoles takes them): no two
+        # threads unload the same role, and pinning one waits until it is out of the policy
+        with self.manager.writeLock:
+            with self.lock:
+                excess = len(self.roles) - self.maxRoles
+                victims = []
+                # roleId -> loaded children not evicted yet
+                remaining = {}
+                # in LRU order, and again for the ancestors the previous pass left childless
+                while excess > 0:
+                    chosen = len(victims)
+                    for roleId, role in self.roles.items():
+                        if excess <= 0:
+                            break
+                        if roleId in keep or roleId in self.pins or remaining.get(roleId, len(role.getChildren())):
+                            continue
+                        remaining[roleId] = -1
+                        victims.append(role)
+                        excess -= 1
+                        for pid, parent in role.getParents().items():
+                            if pid != roleId:
+                                remaining[pid] = remaining.get(pid, len(parent.getChildren())) - 1
+                    if len(victims) == chosen:
+                        break
+                if victims:
+                    self.stats["evictions"] += len(victims)
+                    self.manager.unloadRoles(victims)
+
+    def __setitem__(self, roleId, role):
+        with self.lock:
+            self.missing.pop(roleId, None)
+            self.roles.pop(roleId, None)
+            self.roles[roleId] = role
+
+    def __delitem__(self, roleId):
+        with self.lock:
+            del self.roles[roleId]
+
+    def __contains__(self, roleId):
+        return roleId in self.roles
+
+    def __len__(self):
+        return len(self.roles)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self.roles.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.roles.values())
+
+    def items(self):
+        with self.lock:
+            return list(self.roles.items())
+
 class RoleManager(object):
-    def __init__(self, db, redisdb):
+    bulkItersize = 10000
+    inChunk = 1000
+
+    def __init__(self, db, redisdb, bulkLoad=False, metrics=False, lazy=False, maxRoles=10000):
+        # lazy: only permissions and resource types are read here; roles, with their
+        # ancestors, grants and the resources those need, are read on first access and
+        # at most maxRoles of them stay loaded (see LazyRoles)
+        self.initState(db, redisdb)
+        if metrics:
+            self.enableMetrics()
+        startTime = time.time()
+        with self.loadPhase('permissions'):
+            self.permissionTable = self.getPermissionTable()
+        if lazy:
+            self.lazy = True
+            self.allRoles = LazyRoles(self, maxRoles)
+            roleTable = []
+            self.resourceTable = {}
+        else:
+            # taken before the tables are read, so a write racing the load is picked up by
+            # the first reload() rather than missed
+            with self.loadPhase('stamps'):
+                self.tableStamps = self.getPolicyStamp()
+            with self.loadPhase('roles'):
+                roleTable = self.getRoleTable()
+            with self.loadPhase('resources'):
+                self.resourceTable = self.getResourceTable()
+        with self.loadPhase('resourceTypes'):
+            resourceTypeTable = self.getResourceTypeTable()
+
+        if lazy:
+            with self.loadPhase('build'):
+                with self.batch():
+                    self.buildObjects(resourceTypeTable, roleTable)
+        elif bulkLoad:
+            with self.loadPhase('memberOf'):
+                memberOf = self.getAllRoleMemberOfTable() or {}
+            with self.loadPhase('groupMembers'):
+                groupMembers = self.getAllGroupResourceTable() or {}
+            with self.loadPhase('grants'):
+                rolePermissions = self.getAllRolePermissionResourceTable() or {}
+            with self.loadPhase('build'):
+                with self.batch():
+                    self.buildGraph(resourceTypeTable, roleTable, memberOf, groupMembers, rolePermissions)
+        else:
+            # queries and graph building interleave here, so it is a single phase
+            with self.loadPhase('perRole'):
+                with self.batch():
+                    self.buildObjects(resourceTypeTable, roleTable, queryPermissions=True)
+                    for rid, rname, isLogin in roleTable:
+                        childparents = self.getRoleMemberOfTable(rid)
+                        role = self.allRoles[rid]
+                        for cid, pid in childparents:
+                            role.addParent(self.allRoles[pid])
+                        roleReses = self.getRolePermissionResourceTable(rid)
+                        if roleReses:
+                            for resId in self.getResources(roleReses):
+                                role.addResource(self.allResources[resId], roleReses[resId])
+        if not lazy:
+            with self.loadPhase('version'):
+                with self.batch():
+                    self.localChanges = False
+                    self.sourceVersion = self.stampVersion(self.tableStamps, sorted(changeColumns))
+        self.loadStats = {
+            "mode": "lazy" if lazy else "bulk" if bulkLoad else "perRole",
+            "queries": self.queryCount,
+            "seconds": time.time() - startTime,
+            "phases": self.loadPhases
+        }
+
+    @contextmanager
+    def loadPhase(self, name):
+        startTime = time.time()
+        queries = self.queryCount
+        try:
+            yield
+        finally:
+            self.loadPhases[name] = {"seconds": time.time() - startTime, "queries": self.queryCount - queries}
+
+    def initState(self, db, redisdb):
         self.db = db
         self.redisdb = redisdb
         self.allRoles = {}
+        self.lazy = False
         self.allResources = {}
         self.allResourceTypes = {}
-        self.permissionTable = self.getPermissionTable()
-        roleTable = self.getRoleTable()
-        self.resourceTable = self.getResourceTable()
-        resourceTypeTable = self.getResourceTypeTable()
-
+        self.queryCount = 0
+        self.loadPhases = {}
+        self.metrics = None
+        self.decisionCache = None
+        # readers only ever look at self.policy; writers change the graph under writeLock
+        # and publish a new PolicySnapshot when the outermost batch ends
+        self.policy = PolicySnapshot()
+        self.writeLock = threading.RLock()
+        self.batchDepth = 0
+        self.dirtyRoles = set()
+        self.groupsChanged = False
+        # resources whose groupsOf entry changed since the last publish, None for all of them
+        self.dirtyGroupsOf = set()
+        # resourceId -> ids of the groups holding it directly / through nested groups
+        self.memberOf = {}
+        self.groupsOf = {}
+        self.syncThread = None
+        self.syncStop = threading.Event()
+        self.syncStats = {"failed": 0, "resyncs": 0}
+        # set when a change could not be applied, until a resync succeeds
+        self.resyncNeeded = False
+        self.writeBehind = None
+        # resourceName -> resourceId, the in-process copy of the redis ResourceTable hash
+        self.resourceNames = {}
+        # roleId -> ids reachable through its parent edges other than self loops; filled per
+        # role on first use, extended as edges are added, dropped when one is removed
+        self.ancestors = {}
+        # resourceTypeId -> ids of its resources; resourceId -> {roleId: role} granting it
+        self.resourcesOfType = {}
+        self.grantedBy = {}
+        # > 0 while applying changes that came from the database, which are not written back
+        self.replaying = 0
+        # > 0 while a lazy RoleManager loads or unloads roles; policyChanged is set by any
+        # other change since the last publish, which is what bumps the decision cache version
+        self.loading = 0
+        self.policyChanged = False
+        # what decision cache answers are filed under (see versionPolicy): sourceVersion names
+        # the database state the policy stands for, when other workers can hold it too; a
+        # change made here rather than read from the database leaves a version of our own
+        # until the next reload
+        self.sourceVersion = None
+        self.localChanges = False
+        self.localToken = uuid.uuid4().hex
+        self.localVersion = 0
+        self.versionPolicy(self.policy, True)
+        # table -> fingerprint the in-memory policy was last loaded or reloaded at
+        self.tableStamps = {}
+
+    def buildObjects(self, resourceTypeTable, roleTable, queryPermissions=False):
+        # types, resources and roles from permissionTable/resourceTable and the given rows;
+        # permissions come from permissionTable unless asked to query them per type
+        typePermissions = {}
+        for permId in sorted(self.permissionTable or {}):
+            perm = self.permissionTable[permId]
+            typePermissions.setdefault(perm["resourceTypeId"], {})[permId] = perm["name"]
         for rtid, rtName, desc in resourceTypeTable:
             resourceTypetmp = ResourceType(rtid, rtName, desc)
-            resourceTypetmp.addPermission(self.getResourceTypePermissions(rtid))
+            if queryPermissions:
+                resourceTypetmp.addPermission(self.getResourceTypePermissions(rtid))
+            else:
+                resourceTypetmp.addPermission(typePermissions.get(rtid, {}))
             self.allResourceTypes[rtid] = resourceTypetmp
 
         for resId, row in self.resourceTable.items():
-            if row[4] == 0:
-                tempResource = Resource(
-                    resId=row[0],
-                    name=row[1],
-                    resourceType=self.allResourceTypes[row[2]],
-                    contentId=row[3],
-                    isGroup=row[4]
-                )
-            else:
-                tempResource = ResGroup(
-                    resourceId=row[0],
-                    resourceName=row[1],
-                    resourceType=self.allResourceTypes[row[2]],
-                    contentId=row[3],
-                    isGroup=row[4]
-                )
-            self.allResources[resId] = tempResource
+            self.allResources[resId] = self.buildResource(row)
+            self.resourceNames[row[1]] = resId
+            self.resourcesOfType.setdefault(row[2], set()).add(resId)
         for rid, rname, isLogin in roleTable:
             role = Role(roleId=rid, roleName=rname, isLogin=isLogin)
+            role.manager = self
             self.allRoles[rid] = role
+
+    def buildResource(self, row):
+        if row[4] == 0:
+            return Resource(
+                resId=row[0],
+                name=row[1],
+                resourceType=self.allResourceTypes[row[2]],
+                contentId=row[3],
+                isGroup=row[4]
+            )
+        group = ResGroup(
+            resourceId=row[0],
+            resourceName=row[1],
+            resourceType=self.allResourceTypes[row[2]],
+            contentId=row[3],
+            isGroup=row[4]
+        )
+        group.manager = self
+        return group
+
+    def buildGraph(self, resourceTypeTable, roleTable, memberOf, groupMembers, rolePermissions):
+        # memberOf: childId -> [parentId], groupMembers: groupId -> [resourceId],
+        # rolePermissions: roleId -> {resourceId: [permissionId]}
+        self.buildObjects(resourceTypeTable, roleTable)
+        for groupId, memberIds in groupMembers.items():
+            group = self.allResources[groupId]
+            for resId in memberIds:
+                group.addMember(self.allResources[resId])
         for rid, rname, isLogin in roleTable:
-            childparents = self.getRoleMemberOfTable(rid)
             role = self.allRoles[rid]
-            for cid, pid in childparents:
+            for pid in memberOf.get(rid, ()):
                 role.addParent(self.allRoles[pid])
-            roleReses = self.getRolePermissionResourceTable(rid)
-            if roleReses:
-                for resId in self.getResources(roleReses):
-                    role.addResource(self.allResources[resId], roleReses[resId])
+            for resId, permIds in rolePermissions.get(rid, {}).items():
+                role.addResource(self.allResources[resId], permIds)
+
+    def getLoadStats(self):
+        return self.loadStats
+
+    def selectIn(self, sql, ids):
+        # sql has one "IN ({0})" placeholder; ids are sent in chunks of inChunk
+        ids = sorted(set(int(i) for i in ids))
+        rows = []
+        cur = self.db.cursor()
+        try:
+            for start in range(0, len(ids), self.inChunk):
+                self.queryCount += 1
+                cur.execute(sql.format(', '.join(str(i) for i in ids[start:start + self.inChunk])))
+                rows.extend(cur.fetchall())
+            return rows
+        except Exception as e:
+            print e
+            self.db.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def loadRoles(self, roleIds):
+        # lazy mode: read the roles and their missing ancestors level by level, then their
+        # grants and the resources those need, and register it all as one batch
+        with self.batch():
+            self.replaying += 1
+            self.loading += 1
+            try:
+                roleRows = {}
+                parentsOf = {}
+                wanted = [rid for rid in roleIds if rid not in self.allRoles]
+                while wanted:
+                    for row in self.selectIn('SELECT * FROM t_role WHERE id IN ({0})', wanted):
+                        roleRows[row[0]] = row
+                    edges = self.selectIn('SELECT * FROM t_role_memberof WHERE child_role_id IN ({0})', wanted)
+                    for cid, pid in edges:
+                        parentsOf.setdefault(cid, []).append(pid)
+                    wanted = list(set(pid for cid, pid in edges if pid not in roleRows and pid not in self.allRoles))
+                if not roleRows:
+                    return []
+                grants = self.selectIn('''SELECT role_id, resource_id, permission_id FROM t_role_permission_resource
+                                          WHERE role_id IN ({0})''', list(roleRows))
+                self.loadResources(set(resId for rid, resId, permId in grants))
+                for rid, rname, isLogin in roleRows.values():
+                    role = Role(roleId=rid, roleName=rname, isLogin=isLogin)
+                    role.manager = self
+                    self.allRoles[rid] = role
+                for cid, pids in parentsOf.items():
+                    role = self.allRoles[cid]
+                    for pid in pids:
+                        role.addParent(self.allRoles[pid])
+                rolePermissions = {}
+                for rid, resId, permId in grants:
+                    rolePermissions.setdefault(rid, {}).setdefault(resId, []).append(permId)
+                for rid, resPerms in rolePermissions.items():
+                    role = self.allRoles[rid]
+                    for resId, permIds in resPerms.items():
+                        role.addResource(self.allResources[resId], permIds)
+                return list(roleRows)
+            finally:
+                self.replaying -= 1
+                self.loading -= 1
+
+    def loadResources(self, resourceIds):
+        # resources not loaded yet, with the members of any groups among them
+        wanted = [resId for resId in resourceIds if resId not in self.allResources]
+        memberships = []
+        while wanted:
+            groupIds = []
+            for row in self.selectIn('SELECT * FROM t_resource WHERE id IN ({0})', wanted):
+                self.resourceTable[row[0]] = row
+                self.allResources[row[0]] = self.buildResource(row)
+                self.resourceNames[row[1]] = row[0]
+                self.resourcesOfType.setdefault(row[2], set()).add(row[0])
+                if row[4]:
+                    groupIds.append(row[0])
+            if not groupIds:
+                break
+            members = self.selectIn('SELECT group_id, resource_id FROM t_group_resource WHERE group_id IN ({0})', groupIds)
+            memberships.extend(members)
+            wanted = list(set(resId for groupId, resId in members if resId not in self.allResources))
+        for groupId, resId in memberships:
+            self.allResources[groupId].addMember(self.allResources[resId])
+
+    def unloadRoles(self, roles):
+        # LazyRoles eviction: forget the roles, and resources nothing loaded refers to any more;
+        # nothing is written back
+        with self.batch():
+            self.replaying += 1
+            self.loading += 1
+            try:
+                released = []
+                for role in roles:
+                    for pid, parent in role.getParents().items():
+                        parent.children.pop(role.getId(), None)
+                    for resId, resPerms in role.getResources().items():
+                        self.onGrantRemoved(role, resPerms.getResource())
+                        released.append(resPerms.getResource())
+                    del self.allRoles[role.getId()]
+                    self.ancestors.pop(role.getId(), None)
+                    role.manager = None
+                    role.policy = None
+                    self.onPolicyChange(role)
+                self.releaseResources(released)
+            finally:
+                self.replaying -= 1
+                self.loading -= 1
+
+    def releaseResources(self, resources):
+        # lazy mode: forget the resources granted to no loaded role, directly or through a
+        # group; a forgotten group lets go of its members, which may go in turn
+        stack = list(resources)
+        while stack:
+            res = stack.pop()
+            resId = res.getId()
+            if self.allResources.get(resId) is not res or resId in self.grantedBy:
+                continue
+            if any(groupId in self.grantedBy for groupId in self.groupsOf.get(resId, ())):
+                continue
+            for groupId in list(self.memberOf.get(resId, ())):
+                group = self.allResources[groupId]
+                group.removeMember(res)
+                stack.append(group)
+            if isinstance(res, ResGroup):
+                for member in list(res.getMembers().values()):
+                    res.removeMember(member)
+                    stack.append(member)
+            del self.allResources[resId]
+            self.resourceTable.pop(resId, None)
+            if self.resourceNames.get(res.getName()) == resId:
+                del self.resourceNames[res.getName()]
+            self.resourcesOfType.get(res.getResourceType().getId(), set()).discard(resId)
+            self.onPolicyChange(resourceIds=[resId])
+
+    snapshotMagic = b'RMSSNAP\0'
+    snapshotVersion = 1
+    snapshotHeader = struct.Struct('<8sHIQ')
+
+    def saveSnapshot(self, path):
+        if self.lazy:
+            raise Exception('Error: saveSnapshot needs every role loaded, not a lazy RoleManager')
+        # The stamp is taken from the database at save time, so save right after loading
+        # (or while syncing) for it to describe the graph being written.
+        stamp = self.getPolicyStamp() if self.db is not None else None
+        roleIds = sorted(self.allRoles)
+        resourceIds = sorted(self.allResources)
+        edges = []
+        grants = []
+        for rid in roleIds:
+            role = self.allRoles[rid]
+            for pid in role.getParents():
+                edges.extend((rid, pid))
+            for resId, resPerms in role.getResources().items():
+                for permId in sorted(resPerms.getPermissions()):
+                    grants.extend((rid, resId, permId))
+        groupMembers = []
+        for resId in resourceIds:
+            res = self.allResources[resId]
+            if isinstance(res, ResGroup):
+                for memberId in res.getMembers():
+                    groupMembers.extend((resId, memberId))
+        resources = [self.allResources[resId] for resId in resourceIds]
+        roles = [self.allRoles[rid] for rid in roleIds]
+        texts = {
+            "stamp": stamp,
+            "createdAt": time.time(),
+            "permissions": [[permId, perm["name"], perm["description"], perm["resourceTypeId"]]
+                            for permId, perm in sorted((self.permissionTable or {}).items())],
+            "resourceTypes": [[rt.getId(), rt.getName(), rt.getDesc()]
+                              for rtid, rt in sorted(self.allResourceTypes.items())],
+            "roleNames": [role.getName() for role in roles],
+            "resourceNames": [res.getName() for res in resources],
+            "contentIds": [res.getContentId() for res in resources],
+        }
+        sections = [
+            json.dumps(texts).encode('utf-8'),
+            roleIds,
+            [1 if role.isLogin() else 0 for role in roles],
+            resourceIds,
+            [res.getResourceType().getId() for res in resources],
+            [int(res.getIsGroup()) for res in resources],
+            edges,
+            groupMembers,
+            grants,
+        ]
+        body = []
+        for section in sections:
+            if isinstance(section, list):
+                section = struct.pack('<{0}q'.format(len(section)), *section)
+            body.append(struct.pack('<Q', len(section)))
+            body.append(section)
+        body = zlib.compress(b''.join(body))
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(self.snapshotHeader.pack(self.snapshotMagic, self.snapshotVersion,
+                                             zlib.crc32(body) & 0xffffffff, len(body)))
+            f.write(body)
+        os.rename(tmpPath, path)
+        return True
+
+    @classmethod
+    def readSnapshot(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, checksum, length = cls.snapshotHeader.unpack(f.read(cls.snapshotHeader.size))
+            if magic != cls.snapshotMagic or version != cls.snapshotVersion:
+                raise Exception('Error: {0} is not a version {1} RMS snapshot'.format(path, cls.snapshotVersion))
+            body = f.read()
+        if len(body) != length or zlib.crc32(body) & 0xffffffff != checksum:
+            raise Exception('Error: snapshot {0} is truncated or corrupt'.format(path))
+        body = zlib.decompress(body)
+        sections = []
+        offset = 0
+        while offset < len(body):
+            size = struct.unpack_from('<Q', body, offset)[0]
+            offset += 8
+            sections.append(body[offset:offset + size])
+            offset += size
+        texts = json.loads(sections[0].decode('utf-8'))
+        arrays = [struct.unpack('<{0}q'.format(len(section) // 8), section) for section in sections[1:]]
+        return texts, arrays
+
+    @classmethod
+    def fromSnapshot(cls, path, db=None, redisdb=None):
+        # With a db, the snapshot is checked against the current policy stamp and a stale,
+        # missing or corrupt file falls back to a bulk load from the database.
+        manager = cls.__new__(cls)
+        manager.initState(db, redisdb)
+        startTime = time.time()
+        try:
+            texts, arrays = cls.readSnapshot(path)
+            if db is not None:
+                stamp = manager.getPolicyStamp()
+                if stamp != texts["stamp"]:
+                    raise Exception('Error: snapshot {0} is stale'.format(path))
+        except Exception as e:
+            if db is None:
+                raise
+            print e
+            return cls(db, redisdb, bulkLoad=True)
+        roleIds, roleIsLogin, resourceIds, resourceTypeIds, resourceIsGroup, edges, groupMembers, grants = arrays
+        manager.permissionTable = {}
+        for permId, name, description, resourceTypeId in texts["permissions"]:
+            manager.permissionTable[permId] = {"id": permId, "name": name, "description": description,
+                                               "resourceTypeId": resourceTypeId}
+        manager.resourceTable = {}
+        for i, resId in enumerate(resourceIds):
+            manager.resourceTable[resId] = (resId, texts["resourceNames"][i], resourceTypeIds[i],
+                                            texts["contentIds"][i], resourceIsGroup[i])
+        if redisdb is not None and manager.resourceTable:
+            redisdb.hmset('ResourceTable', dict((row[1], row[0]) for row in manager.resourceTable.values()))
+        roleTable = [(rid, texts["roleNames"][i], roleIsLogin[i] == 1) for i, rid in enumerate(roleIds)]
+        memberOf = {}
+        for i in range(0, len(edges), 2):
+            memberOf.setdefault(edges[i], []).append(edges[i + 1])
+        members = {}
+        for i in range(0, len(groupMembers), 2):
+            members.setdefault(groupMembers[i], []).append(groupMembers[i + 1])
+        rolePermissions = {}
+        for i in range(0, len(grants), 3):
+            rolePermissions.setdefault(grants[i], {}).setdefault(grants[i + 1], []).append(grants[i + 2])
+        with manager.batch():
+            manager.buildGraph([tuple(row) for row in texts["resourceTypes"]], roleTable, memberOf, members,
+                               rolePermissions)
+            manager.localChanges = False
+            if db is not None:
+                manager.sourceVersion = manager.stampVersion(texts["stamp"], ())
+        manager.tableStamps = dict(texts["stamp"] or {})
+        manager.loadStats = {
+            "mode": "snapshot",
+            "queries": manager.queryCount,
+            "seconds": time.time() - startTime
+        }
+        return manager
+
+    def saveMappedPolicy(self, path):
+        if self.lazy:
+            raise Exception('Error: saveMappedPolicy needs every role loaded, not a lazy RoleManager')
+        roleIds = sorted(self.allRoles)
+        roleRows = dict((rid, row) for row, rid in enumerate(roleIds))
+        treeOffsets, treeRows = [0], []
+        grantOffsets, grantResIds, grantMasks = [0], [], []
+        for rid in roleIds:
+            role = self.allRoles[rid]
+            treeRows.extend(sorted(roleRows[pid] for pid in role.getParentTree() if pid in roleRows))
+            treeOffsets.append(len(treeRows))
+            for resId, resPerms in sorted(role.getResources().items()):
+                grantResIds.append(resId)
+                grantMasks.append(resPerms.getMask())
+            grantOffsets.append(len(grantResIds))
+        memberIds = sorted(self.groupsOf)
+        groupOffsets, groupIds = [0], []
+        for resId in memberIds:
+            groupIds.extend(sorted(self.groupsOf[resId]))
+            groupOffsets.append(len(groupIds))
+        if max(grantMasks or [0]) >= 1 << 64:
+            raise Exception('Error: a resource type with more than 64 permission names cannot be mapped')
+        resourceIds = sorted(self.allResources)
+        resourceTypeIds = [self.allResources[resId].getResourceType().getId() for resId in resourceIds]
+        names = dict((rtId, dict((name, bit) for name, bit in rt.permissionBits.items() if bit < 1 << 64))
+                     for rtId, rt in self.allResourceTypes.items())
+        sections = [
+            ('q', roleIds), ('q', treeOffsets), ('q', treeRows),
+            ('q', grantOffsets), ('q', grantResIds), ('Q', grantMasks),
+            ('q', memberIds), ('q', groupOffsets), ('q', groupIds),
+            ('q', resourceIds), ('q', resourceTypeIds),
+            (None, json.dumps(names).encode('utf-8')),
+        ]
+        offset = MappedPolicy.header.size + MappedPolicy.sectionHeader.size * len(sections)
+        headers = [MappedPolicy.header.pack(MappedPolicy.magic, MappedPolicy.version, len(sections))]
+        bodies = []
+        for fmt, values in sections:
+            body = values if fmt is None else struct.pack('<{0}{1}'.format(len(values), fmt), *values)
+            headers.append(MappedPolicy.sectionHeader.pack(offset, len(values)))
+            bodies.append(body)
+            offset += len(body)
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(b''.join(headers))
+            f.write(b''.join(bodies))
+        os.rename(tmpPath, path)
+        return True
+
+    def getTableFingerprint(self, table):
+        try:
+            cur = self.db.cursor()
+            sql = '''SELECT count(*), coalesce(sum(hashtext(t::text)::bigint), 0) FROM {0} t'''.format(table)
+            self.queryCount += 1
+            cur.execute(sql)
+            return [int(value) for value in cur.fetchone()]
+        except Exception as e:
+            print e
+            self.db.rollback()
+            return False
+        finally:
+            cur.close()
+
+    def getPolicyStamp(self):
+        return dict((table, self.getTableFingerprint(table)) for table in sorted(changeColumns))
+
+    # entities before the link tables that refer to them
+    entityTables = ('t_permission', 't_resource_type', 't_resource', 't_role')
+    linkTables = ('t_group_resource', 't_role_memberof', 't_role_permission_resource')
+
+    def reload(self):
+        # Re-reads only the tables whose fingerprint moved since the last reload, the load
+        # or the snapshot the manager came from, and applies the row differences through applyChange in one batch, so indexes and
+        # caches are only dropped for the roles that changed. Returns False when a table
+        # cannot be read; rows that fail to apply leave their table to be compared again.
+        if self.lazy:
+            raise Exception('Error: a lazy RoleManager reads roles on use, there is nothing to reload')
+        startTime = time.time()
+        queries = self.queryCount
+        stamps = self.getPolicyStamp()
+        changed = [table for table in self.entityTables + self.linkTables
+                   if stamps[table] is False or stamps[table] != self.tableStamps.get(table)]
+        fresh = {}
+        for table in changed:
+            fresh[table] = self.readTableRows(table)
+            if fresh[table] is False:
+                return False
+        applied = []
+        with self.batch():
+            upserts = []
+            deletes = []
+            for table in self.entityTables:
+                if table not in fresh:
+                    continue
+                live = dict((row[0], row) for row in self.liveTableRows(table))
+                new = dict((row[0], row) for row in fresh[table])
+                for rowId, row in new.items():
+                    oldRow = live.get(rowId)
+                    if oldRow is None:
+                        upserts.append((table, 'INSERT', row, None))
+                    elif oldRow != row:
+                        upserts.append((table, 'UPDATE', row, oldRow))
+                        if table == 't_resource' and (oldRow[2] != row[2] or bool(oldRow[4]) != bool(row[4])):
+                            # the rebuilt resource keeps only the grants and group links its
+                            # new type allows, so those tables are compared as well
+                            changed.extend(t for t in ('t_group_resource', 't_role_permission_resource')
+                                           if t not in changed)
+                deletes.extend((table, 'DELETE', row, None) for rowId, row in live.items() if rowId not in new)
+            for change in upserts + deletes[::-1]:
+                applied.append((change[0], self.applyChange(*change)))
+            for table in self.linkTables:
+                if table not in changed:
+                    continue
+                if table not in fresh:
+                    fresh[table] = self.readTableRows(table)
+                    if fresh[table] is False:
+                        return False
+                live = self.liveTableRows(table)
+                new = set(fresh[table])
+                for row in live - new:
+                    applied.append((table, self.applyChange(table, 'DELETE', row)))
+                for row in new - live:
+                    applied.append((table, self.applyChange(table, 'INSERT', row)))
+            failedTables = set(table for table, ok in applied if not ok)
+            for table in failedTables:
+                stamps[table] = None
+            # the policy is now the tables' as stamped: changes made here were either
+            # written to them already or have just been undone
+            self.localChanges = False
+            self.sourceVersion = self.stampVersion(stamps, list(fresh))
+        self.tableStamps = stamps
+        return {
+            "changed": changed,
+            "applied": len(applied),
+            "failed": len(applied) - len([ok for table, ok in applied if ok]),
+            "queries": self.queryCount - queries,
+            "seconds": time.time() - startTime
+        }
+
+    def readTableRows(self, table):
+        # the table as a list of tuples in changeColumns order, False when it cannot be read
+        if table == 't_permission':
+            rows = self.getPermissionTable()
+            return rows and [(perm["id"], perm["name"], perm["description"], perm["resourceTypeId"])
+                             for perm in rows.values()]
+        if table == 't_resource_type':
+            rows = self.getResourceTypeTable()
+        elif table == 't_resource':
+            rows = self.getResourceTable()
+            rows = rows and rows.values()
+        elif table == 't_role':
+            rows = self.getRoleTable()
+        elif table == 't_role_memberof':
+            rows = self.getAllRoleMemberOfTable()
+            rows = rows is not False and [(cid, pid) for cid, pids in rows.items() for pid in pids]
+        elif table == 't_group_resource':
+            rows = self.getAllGroupResourceTable()
+            rows = rows is not False and [(groupId, resId) for groupId, resIds in rows.items() for resId in resIds]
+        else:
+            rows = self.getAllRolePermissionResourceTable()
+            rows = rows is not False and [(rid, resId, permId) for rid, resPerms in rows.items()
+                                          for resId, permIds in resPerms.items() for permId in permIds]
+        return rows is not False and [tuple(row) for row in rows]
+
+    def liveTableRows(self, table):
+        # the rows the in-memory policy stands for, as readTableRows would return them
+        if table == 't_permission':
+            return [(perm["id"], perm["name"], perm["description"], perm["resourceTypeId"])
+                    for perm in (self.permissionTable or {}).values()]
+        if table == 't_resource_type':
+            return [(rt.getId(), rt.getName(), rt.getDesc()) for rt in self.allResourceTypes.values()]
+        if table == 't_resource':
+            return [tuple(row) for row in self.resourceTable.values()]
+        if table == 't_role':
+            return [(role.getId(), role.getName(), role.isLogin()) for role in self.allRoles.values()]
+        if table == 't_role_memberof':
+            return set((rid, pid) for rid, role in self.allRoles.items() for pid in role.getParents())
+        if table == 't_group_resource':
+            return set((resId, memberId) for resId, res in self.allResources.items()
+                       if isinstance(res, ResGroup) for memberId in res.getMembers())
+        return set((rid, resId, permId) for rid, role in self.allRoles.items()
+                   for resId, resPerms in role.getResources().items() for permId in resPerms.getPermissions())
+
+    def getPolicy(self):
+        return self.policy
+
+    @contextmanager
+    def batch(self):
+        # mutations made inside become visible to readers together, in one published snapshot
+        with self.writeLock:
+            self.batchDepth += 1
+            try:
+                yield self
+            finally:
+                self.batchDepth -= 1
+                if not self.batchDepth:
+                    self.publishPolicy()
+
+    def onPolicyChange(self, role=None, resourceIds=None):
+        # role: a role whose parents or grants changed; None: group membership changed, for
+        # the groupsOf entries of resourceIds, or for any of them when that is not given
+        with self.writeLock:
+            # roles loaded or unloaded (lazy mode) change what is held, not the policy;
+            # a change read from the database gets its version from syncOnce or reload
+            if not self.loading:
+                self.policyChanged = True
+                self.sourceVersion = None
+                if not self.replaying:
+                    self.localChanges = True
+            if role is None:
+                self.groupsChanged = True
+                if resourceIds is None:
+                    self.dirtyGroupsOf = None
+                elif self.dirtyGroupsOf is not None:
+                    self.dirtyGroupsOf.update(resourceIds)
+            else:
+                self.dirtyRoles.add(role)
+            if not self.batchDepth:
+                self.publishPolicy()
+
+    def publishPolicy(self):
+        with self.writeLock:
+            old = self.policy
+            dirty = self.dirtyRoles
+            groupsChanged = self.groupsChanged
+            if not dirty and not groupsChanged:
+                # the same policy, which may have been given a shared version meanwhile
+                self.versionPolicy(old, False)
+                return old
+            dirtyGroupsOf = self.dirtyGroupsOf
+            self.dirtyRoles = set()
+            self.groupsChanged = False
+            self.dirtyGroupsOf = set()
+            # only the entries of the roles (and resources) touched are written, into a
+            # CowDict that shares everything else with the old snapshot
+            parents = old.parents.derive()
+            grants = old.grants.derive()
+            # bitset rows before indexes: a row is only built once its role's index is, so
+            # every row carried over has its index carried over too
+            bitset = old.bitset
+            bitsetRows = bitset.rows.derive() if bitset is not None else None
+            indexes = old.indexes.derive()
+            resourceBits = old.resourceBits.derive()
+            # a cached index is only ever built after its parents' ones, so a role without
+            # one has no descendant with one and the walk can stop there
+            stack = list(dirty)
+            while stack:
+                role = stack.pop()
+                if indexes.pop(role.getId(), None) is not None:
+                    if bitsetRows is not None:
+                        bitsetRows.pop(role.getId(), None)
+                    stack.extend(role.getChildren().values())
+            done = set()
+            pending = [(role, role.manager is self) for role in dirty]
+            while pending:
+                role, present = pending.pop()
+                rid = role.getId()
+                if rid in done:
+                    continue
+                done.add(rid)
+                if present:
+                    parents[rid] = tuple(role.getParents())
+                    grants[rid] = role.getGrantMasks()
+                    for resId, resPerms in role.getResources().items():
+                        bits = resPerms.getResource().getResourceType().permissionBits
+                        if resourceBits.get(resId) is not bits:
+                            resourceBits[resId] = bits
+                    # parents that were never registered still have to be in the snapshot, and
+                    # are read again each time: their own changes only get here through a child
+                    for pid, parent in role.getParents().items():
+                        if pid not in parents or parent.manager is None and pid != rid:
+                            if indexes.pop(pid, None) is not None and bitsetRows is not None:
+                                bitsetRows.pop(pid, None)
+                            pending.append((parent, True))
+                else:
+                    parents.pop(rid, None)
+                    grants.pop(rid, None)
+            if not groupsChanged:
+                groupsOf = old.groupsOf
+            elif dirtyGroupsOf is None:
+                groupsOf = CowDict(dict(self.groupsOf))
+            else:
+                groupsOf = old.groupsOf.derive()
+                for resId in dirtyGroupsOf:
+                    if resId in self.groupsOf:
+                        groupsOf[resId] = self.groupsOf[resId]
+                    else:
+                        groupsOf.pop(resId, None)
+            if groupsChanged:
+                # the bits of group members, and of resources dropped or rebuilt
+                for resId in (self.groupsOf if dirtyGroupsOf is None else dirtyGroupsOf):
+                    res = self.allResources.get(resId)
+                    if res is not None:
+                        bits = res.getResourceType().permissionBits
+                    else:
+                        # a member never registered has the type of the groups holding it
+                        bits = next((resourceBits[groupId] for groupId in self.groupsOf.get(resId, ())
+                                     if groupId in resourceBits), None)
+                    if bits is not None:
+                        if resourceBits.get(resId) is not bits:
+                            resourceBits[resId] = bits
+                    elif resId not in self.grantedBy:
+                        resourceBits.pop(resId, None)
+            policy = PolicySnapshot(old.generation + 1, parents, grants, groupsOf, indexes, resourceBits)
+            policy.version = old.version
+            self.versionPolicy(policy, self.policyChanged)
+            self.policyChanged = False
+            policy.inheritInverted(old, done, dirtyGroupsOf if groupsChanged else ())
+            if bitsetRows is not None:
+                policy.bitset = PermissionBitset(policy, bitsetRows)
+            self.policy = policy
+            return self.policy
+
+    def versionPolicy(self, policy, changed):
+        # the shared version while the policy is the database's as named by sourceVersion,
+        # else one of this process's own, moved on by every change
+        if self.sourceVersion is not None and not self.localChanges:
+            policy.version = self.sourceVersion
+        elif changed or policy.version is None:
+            self.localVersion += 1
+            policy.version = 'local:{0}:{1}'.format(self.localToken, self.localVersion)
+
+    def stampVersion(self, stamps, tables):
+        # the version of a policy read from the tables at stamps, shared by every worker
+        # that read them at the same stamps. None when a stamp is missing, or when one of
+        # tables, read after stamping, has moved since: a write raced the reading
+        if any(stamp is None or stamp is False for stamp in stamps.values()):
+            return None
+        if any(self.getTableFingerprint(table) != stamps[table] for table in tables):
+            return None
+        return 'stamp:' + hashlib.sha1(json.dumps(sorted(stamps.items())).encode('utf-8')).hexdigest()
+
+    def enableDecisionCache(self, **options):
+        self.decisionCache = DecisionCache(self.redisdb, **options)
+        return self.decisionCache
+
+    def disableDecisionCache(self):
+        self.decisionCache = None
+
+    def hasPermission(self, roleId, resourceId, permission):
+        return self.hasPermissionMany([(roleId, resourceId, permission)])[0]
+
+    def hasPermissionMany(self, checks):
+        if self.metrics is not None:
+            self.metrics.count('hasPermissionChecks', n=len(checks))
+            return self.metrics.timed('hasPermissionMany', self.checkPermissions, checks)
+        return self.checkPermissions(checks)
+
+    def checkPermissions(self, checks):
+        # checks are (roleId, resourceId, permission); answered from the decision cache
+        # when enabled, the misses computed from the graph and written back in one pipeline
+        checks = [tuple(check) for check in checks]
+        cache = self.decisionCache
+        policy = self.policy
+        if cache is not None:
+            results = cache.getMany(checks, policy.version)
+        else:
+            results = [None] * len(checks)
+        if self.lazy:
+            # the roles stay loaded until the policy holding them has been read
+            with self.allRoles.pinned(set(check[0] for check, result in zip(checks, results) if result is None)):
+                policy = self.policy
+        computed = []
+        for i, check in enumerate(checks):
+            if results[i] is None:
+                results[i] = policy.hasPermission(check[0], check[1], check[2])
+                computed.append(i)
+        if cache is not None and computed:
+            # filed under the version of the policy they were computed from
+            cache.setMany([checks[i] for i in computed], [results[i] for i in computed], policy.version)
+        return results
+
+    def getAncestors(self, role):
+        ancestors = self.ancestors.get(role.getId())
+        if ancestors is not None:
+            return ancestors
+        with self.writeLock:
+            # a parent with a closure of its own is taken whole instead of walked
+            ancestors = set()
+            stack = [role]
+            while stack:
+                current = stack.pop()
+                for pid, parent in current.getParents().items():
+                    if pid == current.getId() or pid in ancestors:
+                        continue
+                    ancestors.add(pid)
+                    known = self.ancestors.get(pid) if parent.manager is self else None
+                    if known is not None:
+                        ancestors |= known
+                    else:
+                        stack.append(parent)
+            if role.manager is self:
+                self.ancestors[role.getId()] = ancestors
+            return ancestors
+
+    def onParentAdded(self, role, parent):
+        # the parent and its ancestors join the closures of the role and its descendants;
+        # a closure that has them all already means the ones below it do too
+        if parent is role:
+            return
+        with self.writeLock:
+            added = set([parent.getId()])
+            added |= self.getAncestors(parent)
+            seen = set()
+            stack = [role]
+            while stack:
+                current = stack.pop()
+                if current.getId() in seen:
+                    continue
+                seen.add(current.getId())
+                ancestors = self.ancestors.get(current.getId())
+                if ancestors is not None:
+                    if added <= ancestors:
+                        continue
+                    ancestors |= added
+                stack.extend(current.getChildren().values())
+
+    def forgetAncestors(self, role):
+        # after an edge removal (or edges the manager never saw) the closures of the role and
+        # its descendants are dropped and rebuilt on next use
+        with self.writeLock:
+            seen = set()
+            stack = [role]
+            while stack:
+                current = stack.pop()
+                if current.getId() not in seen:
+                    seen.add(current.getId())
+                    self.ancestors.pop(current.getId(), None)
+                    stack.extend(current.getChildren().values())
+
+    def getGroupsOf(self, resourceId):
+        return self.groupsOf.get(resourceId, EMPTYSET)
+
+    def onGrantAdded(self, role, resource):
+        self.grantedBy.setdefault(resource.getId(), {})[role.getId()] = role
+        # a group built outside the manager: its members only count once indexed
+        if isinstance(resource, ResGroup) and resource.manager is None:
+            self.indexGroup(resource)
+
+    def onGrantRemoved(self, role, resource):
+        roles = self.grantedBy.get(resource.getId())
+        if roles is not None:
+            roles.pop(role.getId(), None)
+            if not roles:
+                del self.grantedBy[resource.getId()]
+
+    def onGroupMemberAdded(self, group, member):
+        self.memberOf.setdefault(member.getId(), set()).add(group.getId())
+        self.refreshGroupsOf(member)
+        self.persist('t_group_resource', 'INSERT', (group.getId(), member.getId()))
+
+    def onGroupMemberRemoved(self, group, member):
+        self.persist('t_group_resource', 'DELETE', (group.getId(), member.getId()))
+        groupIds = self.memberOf.get(member.getId())
+        if groupIds is not None:
+            groupIds.discard(group.getId())
+            if not groupIds:
+                del self.memberOf[member.getId()]
+        self.refreshGroupsOf(member)
+
+    def refreshGroupsOf(self, member):
+        # the closure changes for the member itself and, for a nested group, everything below it
+        affected = [member.getId()]
+        if isinstance(member, ResGroup):
+            affected.extend(member.getAllMembers())
+        for resId in affected:
+            closure = set()
+            stack = list(self.memberOf.get(resId, ()))
+            while stack:
+                groupId = stack.pop()
+                if groupId not in closure:
+                    closure.add(groupId)
+                    stack.extend(self.memberOf.get(groupId, ()))
+            if closure:
+                self.groupsOf[resId] = frozenset(closure)
+            else:
+                self.groupsOf.pop(resId, None)
+        self.onPolicyChange(resourceIds=affected)
+
+    def indexGroup(self, group):
+        group.manager = self
+        for resId, member in group.getMembers().items():
+            if isinstance(member, ResGroup) and member.manager is None:
+                self.indexGroup(member)
+            self.onGroupMemberAdded(group, member)
+
+    def accessibleResources(self, roleId, permission, pageSize=1000):
+        # pages of resource ids, groups granted to the role expanded to their members;
+        # read from one policy snapshot however long the caller takes to consume it
+        if self.lazy:
+            with self.allRoles.pinned([roleId]):
+                policy = self.policy
+        else:
+            policy = self.policy
+        return paginate(policy.accessibleResources(roleId, permission), pageSize)
+
+    def rolesWithAccess(self, resourceId, permission, pageSize=1000):
+        # pages of role ids, in no particular order
+        if self.lazy:
+            raise Exception('Error: rolesWithAccess needs every role loaded, not a lazy RoleManager')
+        return paginate(self.policy.rolesWithAccess(resourceId, permission), pageSize)
+
+    def exportPolicy(self, path, processes=None, chunkSize=200):
+        # Audit dump of every effective (role, resource, permission) triple, group grants
+        # expanded to their members, as CSV. The roles of the current policy snapshot are
+        # split into chunks for a process pool, at most two per process in flight; they are
+        # written in order as they complete, so neither side holds more than a few chunks
+        # of rows. The file appears under path only once it is complete.
+        if self.lazy:
+            raise Exception('Error: exportPolicy needs every role loaded, not a lazy RoleManager')
+        policy = self.policy
+        roleIds = sorted(policy.parents)
+        chunks = [roleIds[i:i + chunkSize] for i in range(0, len(roleIds), chunkSize)]
+        processes = processes or multiprocessing.cpu_count()
+        startTime = time.time()
+        rows = 0
+        tables = (dict(policy.parents.items()), dict(policy.grants.items()), dict(policy.groupsOf.items()),
+                  dict(policy.resourceBits.items()))
+        pool = multiprocessing.Pool(processes, initExportWorker, tables)
+        tmpPath = path + '.tmp'
+        try:
+            with open(tmpPath, 'w') as f:
+                f.write('role_id,resource_id,permission\n')
+                inFlight = deque()
+                for chunk in chunks + [None]:
+                    while inFlight and (chunk is None or len(inFlight) >= 2 * processes):
+                        nRoles, nRows, text = inFlight.popleft().get()
+                        f.write(text)
+                        rows += nRows
+                    if chunk is not None:
+                        inFlight.append(pool.apply_async(exportChunk, (chunk,)))
+            os.rename(tmpPath, path)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+        seconds = time.time() - startTime
+        return {
+            "processes": processes,
+            "roles": len(roleIds),
+            "rows": rows,
+            "seconds": seconds,
+            "rolesPerSecond": len(roleIds) / seconds if seconds else None,
+            "rowsPerSecond": rows / seconds if seconds else None
+        }
+
+    def getPermissionBitset(self):
+        return self.policy.getBitset()
+
+    def checkMany(self, roleIds, resourceIds, permissions):
+        # permissions is either one name for every resource or one name per resource;
+        # the result is a len(roleIds) x len(resourceIds) boolean numpy array
+        if numpy is None:
+            raise ImportError("checkMany needs numpy")
+        if isinstance(permissions, tuple) or isinstance(permissions, list):
+            if len(permissions) != len(resourceIds):
+                raise ValueError("checkMany needs one permission per resource")
+        else:
+            permissions = [permissions] * len(resourceIds)
+        if self.lazy:
+            with self.allRoles.pinned(roleIds):
+                policy = self.policy
+        else:
+            policy = self.policy
+        wantedBits = [policy.getPermissionBit(resId, name) for resId, name in zip(resourceIds, permissions)]
+        return policy.getBitset().check(roleIds, resourceIds, wantedBits)
+
+    def enableMetrics(self):
+        if self.metrics is None:
+            self.metrics = Metrics()
+        return self.metrics
+
+    def disableMetrics(self):
+        self.metrics = None
+
+    def countRedis(self, command):
+        if self.metrics is not None:
+            self.metrics.count('redisRoundTrips', command)
+
+    def stats(self):
+        stats = {
+            "roles": len(self.allRoles),
+            "resources": len(self.allResources),
+            "queries": self.queryCount,
+            "policyGeneration": self.policy.generation,
+            "load": self.loadStats,
+        }
+        if self.decisionCache is not None:
+            stats["decisionCache"] = self.decisionCache.getStats()
+        if self.writeBehind is not None:
+            stats["writeBehind"] = self.writeBehind.getStats()
+        if self.lazy:
+            stats["lazyRoles"] = self.allRoles.getStats()
+        if self.metrics is not None:
+            stats.update(self.metrics.getStats())
+        return stats
+
+    def prometheusText(self, prefix='rms'):
+        # Prometheus text exposition format, for a /metrics handler to return as is
+        lines = []
+        gauges = [('roles', len(self.allRoles)), ('resources', len(self.allResources)),
+                  ('policy_generation', self.policy.generation)]
+        for name, value in gauges:
+            lines.append('# TYPE {0}_{1} gauge'.format(prefix, name))
+            lines.append('{0}_{1} {2}'.format(prefix, name, value))
+        lines.append('# TYPE {0}_queries_total counter'.format(prefix))
+        lines.append('{0}_queries_total {1}'.format(prefix, self.queryCount))
+        phases = sorted((self.loadStats or {}).get("phases", {}).items())
+        for field, kind in (('seconds', 'load_seconds'), ('queries', 'load_queries')):
+            if phases:
+                lines.append('# TYPE {0}_{1} gauge'.format(prefix, kind))
+            for phase, values in phases:
+                lines.append('{0}_{1}{{phase="{2}"}} {3!r}'.format(prefix, kind, phase, values[field]))
+        for source, values in (('decision_cache', self.decisionCache and self.decisionCache.getStats()),
+                               ('write_behind', self.writeBehind and self.writeBehind.getStats())):
+            for name, value in sorted((values or {}).items()):
+                kind = 'gauge' if name == 'pending' else 'counter'
+                metric = '{0}_{1}_{2}{3}'.format(prefix, source, metricName(name), '_total' if kind == 'counter' else '')
+                lines.append('# TYPE {0} {1}'.format(metric, kind))
+                lines.append('{0} {1}'.format(metric, value))
+        if self.metrics is not None:
+            lines.extend(self.metrics.prometheusLines(prefix))
+        return '\n'.join(lines) + '\n'
+
+    def enableWriteBehind(self, db=None, **options):
+        # options: flushInterval (seconds, None for size-triggered flushes only), flushSize,
+        # maxRetries, maxPending
+        self.disableWriteBehind()
+        self.writeBehind = WriteBehind(db or self.db, self.redisdb, **options)
+        return self.writeBehind
+
+    def disableWriteBehind(self):
+        writeBehind, self.writeBehind = self.writeBehind, None
+        if writeBehind is not None:
+            return writeBehind.close()
+        return True
+
+    def flush(self):
+        if self.writeBehind is not None:
+            return self.writeBehind.flush()
+        return True
+
+    def persist(self, table, op, row):
+        if self.writeBehind is not None and not self.replaying:
+            self.writeBehind.add(table, op, row)
+
+    def writeNames(self, names, op='HSET'):
+        # names: {resourceName: resourceId} to set in (or delete from) the redis ResourceTable hash
+        if not names:
+            return
+        if op == 'HSET':
+            self.resourceNames.update(names)
+        else:
+            for name, resId in names.items():
+                if self.resourceNames.get(name) == resId:
+                    del self.resourceNames[name]
+        if self.replaying:
+            # the change came from the database, whose writer updated the hash already
+            return
+        if self.writeBehind is not None:
+            for name, resId in names.items():
+                self.writeBehind.add('ResourceTable', op, (name, resId))
+        elif op == 'HSET':
+            self.countRedis('hmset')
+            self.redisdb.hmset('ResourceTable', names)
+        else:
+            self.countRedis('hdel')
+            self.redisdb.hdel('ResourceTable', *names)
+
+    def resourceRow(self, res):
+        return (res.getId(), res.getName(), res.getResourceType().getId(), res.contentId, res.isGroup)
 
     def permIdToName(self, ins):
         try:
@@ -296,102 +2706,387 @@ class RoleManager(object):
 
     def registRole(self, role):
         try:
-            if isinstance(role, Role):
-                if not role.getId() in self.allRoles:
-                    self.allRoles[role.getId()] = role
-            return True
+            with self.batch():
+                if isinstance(role, Role):
+                    if not role.getId() in self.allRoles:
+                        self.allRoles[role.getId()] = role
+                        role.manager = self
+                        self.forgetAncestors(role)
+                        self.onPolicyChange(role)
+                        self.persist('t_role', 'INSERT', (role.getId(), role.getName(), role.isLogin()))
+                        # edges and grants the role was given before it was registered
+                        for pid in role.getParents():
+                            self.persist('t_role_memberof', 'INSERT', (role.getId(), pid))
+                        for resId, resPerms in role.getResources().items():
+                            role.persistGrant('INSERT', resPerms)
+                            self.onGrantAdded(role, resPerms.getResource())
+                return True
         except Exception as e:
             print e
             return False
 
     def removeRole(self, role):
         try:
-            if isinstance(role, Role):
-                if role.getId() in self.allRoles:
-                    for roId, ro in self.allRoles.items():
-                        if roId != role.getId():
-                            ro.removeParent(role)
-                    del self.allRoles[role.getId()]
-            return True
+            with self.batch():
+                if isinstance(role, Role):
+                    if role.getId() in self.allRoles:
+                        for cid, child in list(role.getChildren().items()):
+                            child.removeParent(role)
+                        for pid, parent in role.getParents().items():
+                            parent.children.pop(role.getId(), None)
+                            self.persist('t_role_memberof', 'DELETE', (role.getId(), pid))
+                        for resId, resPerms in role.getResources().items():
+                            role.persistGrant('DELETE', resPerms)
+                            self.onGrantRemoved(role, resPerms.getResource())
+                        self.persist('t_role', 'DELETE', (role.getId(), role.getName(), role.isLogin()))
+                        del self.allRoles[role.getId()]
+                        self.ancestors.pop(role.getId(), None)
+                        role.manager = None
+                        role.policy = None
+                        self.onPolicyChange(role)
+                return True
         except Exception as e:
             print e
             return False
 
     def registResource(self, resources):
         try:
-            if isinstance(resources, tuple) or isinstance(resources, list):
-                for res in resources:
-                    if isinstance(res, Resource):
-                        if not res.getId() in self.allResources:
-                            self.allResources[res.getId()] = res
-                            self.redisdb.hset('ResourceTable', res.getName(), res.getId())
+            with self.batch():
+                names = {}
+                if isinstance(resources, tuple) or isinstance(resources, list):
+                    for res in resources:
+                        if isinstance(res, Resource):
+                            if not res.getId() in self.allResources:
+                                self.allResources[res.getId()] = res
+                                self.resourcesOfType.setdefault(res.getResourceType().getId(), set()).add(res.getId())
+                                names[res.getName()] = res.getId()
+                                self.persist('t_resource', 'INSERT', self.resourceRow(res))
+                                if isinstance(res, ResGroup):
+                                    self.indexGroup(res)
 
-            else:
-                if isinstance(resources, Resource):
-                    self.allResources[resources.getId()] = resources
-                    self.redisdb.hset('ResourceTable', resources.getName(), resources.getId())
-            return True
+                else:
+                    if isinstance(resources, Resource):
+                        self.allResources[resources.getId()] = resources
+                        self.resourcesOfType.setdefault(resources.getResourceType().getId(), set()).add(resources.getId())
+                        names[resources.getName()] = resources.getId()
+                        self.persist('t_resource', 'INSERT', self.resourceRow(resources))
+                        if isinstance(resources, ResGroup):
+                            self.indexGroup(resources)
+                self.writeNames(names)
+                return True
         except Exception as e:
             print e
             return False
 
     def removeResource(self, resources):
         try:
-            if isinstance(resources, tuple) or isinstance(resources, list):
-                for res in resources:
-                    if isinstance(res, Resource):
-                        if res.getId() in self.allResources:
-                            del self.allResources[res.getId()]
-                            self.redisdb.hdel('ResourceTable', res.getName())
-            else:
-                if isinstance(resources, Resource):
-                    if resources.getId() in self.allResources:
-                        self.allResources[resources.getId()] = resources
-                        self.redisdb.hdel('ResourceTable', resources.getName())
-            return True
+            with self.batch():
+                names = {}
+                if isinstance(resources, tuple) or isinstance(resources, list):
+                    for res in resources:
+                        if isinstance(res, Resource):
+                            if res.getId() in self.allResources:
+                                del self.allResources[res.getId()]
+                                self.resourcesOfType.get(res.getResourceType().getId(), set()).discard(res.getId())
+                                names[res.getName()] = res.getId()
+                                self.persist('t_resource', 'DELETE', self.resourceRow(res))
+                                self.onPolicyChange(resourceIds=[res.getId()])
+                else:
+                    if isinstance(resources, Resource):
+                        if resources.getId() in self.allResources:
+                            del self.allResources[resources.getId()]
+                            self.resourcesOfType.get(resources.getResourceType().getId(), set()).discard(resources.getId())
+                            names[resources.getName()] = resources.getId()
+                            self.persist('t_resource', 'DELETE', self.resourceRow(resources))
+                            self.onPolicyChange(resourceIds=[resources.getId()])
+                self.writeNames(names, 'HDEL')
+                return True
         except Exception as e:
             print e
             return False
 
     def addResourceType(self, resourceType):
         try:
-            if isinstance(resourceType, ResourceType):
-                if resourceType.getId() not in self.allResourceTypes:
-                    self.allResourceTypes[resourceType.getId()] = resourceType
+            with self.batch():
+                if isinstance(resourceType, ResourceType):
+                    if resourceType.getId() not in self.allResourceTypes:
+                        self.allResourceTypes[resourceType.getId()] = resourceType
+                        self.persist('t_resource_type', 'INSERT', (resourceType.getId(), resourceType.getName(),
+                                                                   resourceType.getDesc()))
+                    return True
                 return True
-            return True
         except Exception as e:
             print e
             return False
 
     def removeResourceType(self, resourceTypeId):
         try:
-            for rid, role in self.allRoles.items():
-                for resId, resPerms in role.getResources().items():
-                    resInstance = resPerms.getResource()
-                    if resInstance.getResourceType().getId() == resourceTypeId:
-                        del role.resources[resId]
-            for resId, res in self.allResources.items():
-                if res.getResourceType().getId() == resourceTypeId:
-                    del self.allResources[resId]
-            if resourceTypeId in self.allResourceTypes:
-                del self.allResourceTypes[resourceTypeId]
-            return True
+            with self.batch():
+                names = {}
+                for resId in self.resourcesOfType.pop(resourceTypeId, ()):
+                    res = self.allResources.pop(resId)
+                    for rid, role in list(self.grantedBy.get(resId, {}).items()):
+                        role.removeResource(res)
+                    names[res.getName()] = resId
+                    self.persist('t_resource', 'DELETE', self.resourceRow(res))
+                self.writeNames(names, 'HDEL')
+                if resourceTypeId in self.allResourceTypes:
+                    resourceType = self.allResourceTypes.pop(resourceTypeId)
+                    self.persist('t_resource_type', 'DELETE', (resourceTypeId, resourceType.getName(),
+                                                               resourceType.getDesc()))
+                return True
         except Exception as e:
             print e
             return False
 
+    def removeRoles(self, roles):
+        # one published snapshot and one decision cache bump for the whole list
+        with self.batch():
+            return all([self.removeRole(role) for role in roles])
+
+    def removeResourceTypes(self, resourceTypeIds):
+        with self.batch():
+            return all([self.removeResourceType(resourceTypeId) for resourceTypeId in resourceTypeIds])
+
+    def applyChange(self, table, op, row, oldRow=None):
+        try:
+            with self.batch():
+                # the database already has these rows, so none of it is written back
+                self.replaying += 1
+                try:
+                    columns = changeColumns[table]
+                    if isinstance(row, dict):
+                        row = tuple(row.get(column) for column in columns)
+                    if isinstance(oldRow, dict):
+                        oldRow = tuple(oldRow.get(column) for column in columns)
+                    if self.lazy and table == 't_role':
+                        self.allRoles.forgetMissing(row[0])
+                    if table == 't_resource':
+                        self.applyResourceName(op, row, oldRow)
+                    if self.isUnloaded(table, row):
+                        return True
+                    if self.lazy and table in ('t_role_permission_resource', 't_group_resource'):
+                        self.loadResources([row[1]])
+                    if op == 'UPDATE' and table in ('t_role_memberof', 't_group_resource', 't_role_permission_resource'):
+                        # link rows have no identity of their own: drop the old link, add the new one
+                        self.applyChange(table, 'DELETE', oldRow)
+                        op = 'INSERT'
+                    if table == 't_role':
+                        self.applyRoleChange(op, row)
+                    elif table == 't_role_memberof':
+                        child = self.allRoles[row[0]]
+                        if op == 'INSERT':
+                            child.addParent(self.allRoles[row[1]])
+                        elif row[1] in self.allRoles:
+                            child.removeParent(self.allRoles[row[1]])
+                    elif table == 't_role_permission_resource':
+                        self.applyGrantChange(op, row)
+                    elif table == 't_group_resource':
+                        group = self.allResources[row[0]]
+                        if op == 'INSERT':
+                            group.addMember(self.allResources[row[1]])
+                        elif row[1] in self.allResources:
+                            group.removeMember(self.allResources[row[1]])
+                    elif table == 't_resource':
+                        self.applyResourceChange(op, row, oldRow)
+                    elif table == 't_resource_type':
+                        if op == 'DELETE':
+                            self.removeResourceType(row[0])
+                        elif row[0] in self.allResourceTypes:
+                            self.allResourceTypes[row[0]].name = row[1]
+                            self.allResourceTypes[row[0]].description = row[2]
+                        else:
+                            self.addResourceType(ResourceType(row[0], row[1], row[2]))
+                    elif table == 't_permission':
+                        self.applyPermissionChange(op, row)
+                    return True
+                finally:
+                    self.replaying -= 1
+        except Exception as e:
+            print e
+            return False
+
+    def isUnloaded(self, table, row):
+        # lazy mode ignores changes to roles and resources nobody has asked for yet: they
+        # are read fresh from the database on first use
+        if not self.lazy:
+            return False
+        if table in ('t_role', 't_role_memberof', 't_role_permission_resource'):
+            return row[0] not in self.allRoles
+        if table in ('t_resource', 't_group_resource'):
+            return row[0] not in self.allResources
+        return False
+
+    def applyRoleChange(self, op, row):
+        rid, rname, isLogin = row
+        if op == 'DELETE':
+            if rid in self.allRoles:
+                self.removeRole(self.allRoles[rid])
+        elif rid in self.allRoles:
+            self.allRoles[rid].name = rname
+            self.allRoles[rid].is_Login = isLogin
+        else:
+            self.registRole(Role(roleId=rid, roleName=rname, isLogin=isLogin))
+
+    def applyGrantChange(self, op, row):
+        rid, resId, permId = row
+        role = self.allRoles[rid]
+        resPerms = role.getResources().get(resId)
+        if op == 'INSERT':
+            if resPerms is None:
+                role.addResource(self.allResources[resId], [permId])
+            else:
+                resPerms.addPermission(permId)
+        elif resPerms is not None:
+            if resPerms.getMask() & resPerms.getResource().getResourceType().getPermissionMask(permId):
+                resPerms.removePermission(permId)
+            if not resPerms.getMask():
+                role.removeResource(resPerms.getResource())
+
+    def applyResourceChange(self, op, row, oldRow):
+        resId = row[0]
+        if op == 'DELETE':
+            if resId in self.allResources:
+                self.removeResource(self.allResources[resId])
+            self.resourceTable.pop(resId, None)
+        elif resId in self.allResources:
+            res = self.allResources[resId]
+            if res.getName() != row[1]:
+                self.writeNames({res.getName(): resId}, 'HDEL')
+                self.writeNames({row[1]: resId})
+            if res.getResourceType().getId() != row[2] or bool(res.getIsGroup()) != bool(row[4]):
+                self.rebuildResource(res, row)
+            else:
+                res.name = row[1]
+                res.contentId = row[3]
+            self.resourceTable[resId] = row
+        else:
+            self.resourceTable[resId] = row
+            self.registResource(self.buildResource(row))
+
+    def applyResourceName(self, op, row, oldRow):
+        # resourceNames also holds names read from redis for resources this process never
+        # loaded, so every t_resource change reaches it, loaded resource or not
+        resId = row[0]
+        if oldRow is None:
+            oldRow = self.resourceTable.get(resId)
+        for name in set([row[1], oldRow and oldRow[1]]):
+            if name is not None and self.resourceNames.get(name) == resId:
+                del self.resourceNames[name]
+        if op != 'DELETE':
+            self.resourceNames[row[1]] = resId
+
+    def rebuildResource(self, old, row):
+        # a resource changing type or group flag is a new object. Its grants move over while
+        # the type stays; a new type has none of the permission ids the grant rows name, so
+        # they are dropped, for the database's own grant changes (or a reload) to bring back.
+        # The group links that still hold (groups of its type, its own members while it
+        # stays a group) move over too.
+        resId = old.getId()
+        new = self.buildResource(row)
+        self.allResources[resId] = new
+        self.resourcesOfType.get(old.getResourceType().getId(), set()).discard(resId)
+        self.resourcesOfType.setdefault(new.getResourceType().getId(), set()).add(resId)
+        newType = new.getResourceType()
+        for role in list(self.grantedBy.get(resId, {}).values()):
+            if old.getResourceType() is newType:
+                role.getResources()[resId].resource = new
+                role.invalidatePermissionIndex()
+            else:
+                role.removeResource(old)
+        for groupId in list(self.memberOf.get(resId, ())):
+            group = self.allResources[groupId]
+            if group.getResourceType() is newType:
+                group.groupMember[resId] = new
+            else:
+                group.removeMember(old)
+        if isinstance(old, ResGroup):
+            for memberId, member in list(old.getMembers().items()):
+                if isinstance(new, ResGroup) and member.getResourceType() is newType:
+                    if new.groupMember is EMPTY:
+                        new.groupMember = {}
+                    new.groupMember[memberId] = member
+                else:
+                    old.removeMember(member)
+        self.onPolicyChange(resourceIds=[resId])
+        return new
+
+    def applyPermissionChange(self, op, row):
+        permId, name, description, resourceTypeId = row
+        resourceType = self.allResourceTypes.get(resourceTypeId)
+        if op == 'DELETE':
+            self.permissionTable.pop(permId, None)
+            if resourceType is not None:
+                resourceType.removePermission(permId)
+        elif op == 'UPDATE' and permId in self.permissionTable and self.permissionTable[permId]["name"] != name:
+            # grants hold the bit of the old name, so a rename cannot be applied row by row
+            raise Exception('Error: permission <id:{0}> renamed, reload the RoleManager'.format(permId))
+        else:
+            self.permissionTable[permId] = {"id": permId, "name": name, "description": description,
+                                            "resourceTypeId": resourceTypeId}
+            if resourceType is not None:
+                resourceType.addPermission({permId: name})
+
+    def syncOnce(self, source, timeout=0):
+        events = source.poll(timeout)
+        with self.batch():
+            failed = [event for event in events if not self.applyChange(*event)]
+            # a source numbering its events the same for every worker names the policy
+            # each of them holds once it has applied everything up to that position
+            getPosition = getattr(source, 'getPosition', None)
+            if events and not failed and getPosition is not None:
+                self.sourceVersion = getPosition()
+        if failed:
+            self.syncStats["failed"] += len(failed)
+            self.resyncNeeded = True
+        if self.resyncNeeded:
+            self.resyncNeeded = not self.resync()
+        return len(events)
+
+    def resync(self):
+        # an event that could not be applied is lost, so the graph is brought back in line
+        # with the tables as a whole: reloaded, or in lazy mode read afresh on next use
+        self.syncStats["resyncs"] += 1
+        if self.lazy:
+            self.unloadRoles(self.allRoles.values())
+            return True
+        return self.reload() is not False
+
+    def startSync(self, source, timeout=1.0):
+        if self.syncThread is not None:
+            raise Exception('Error: RoleManager is already syncing')
+        self.syncStop.clear()
+        self.syncThread = threading.Thread(target=self.syncLoop, args=(source, timeout))
+        self.syncThread.daemon = True
+        self.syncThread.start()
+
+    def syncLoop(self, source, timeout):
+        while not self.syncStop.is_set():
+            try:
+                self.syncOnce(source, timeout)
+            except Exception as e:
+                print e
+                self.syncStop.wait(timeout)
+
+    def stopSync(self):
+        if self.syncThread is not None:
+            self.syncStop.set()
+            self.syncThread.join()
+            self.syncThread = None
+
     def getResourceTypeTable(self, rtId=None):
         try:
             cur = self.db.cursor()
             if rtId is None:
                 sql = '''SELECT * FROM t_resource_type;'''
+                self.queryCount += 1
                 cur.execute(sql)
                 if cur.rowcount == 0:
                     raise Exception('Error: visit t_resource_type failed!!!')
                 return cur.fetchall()
             else:
                 sql = '''SELECT * FROM t_resource_type WHERE id={0};'''.format(rtId)
+                self.queryCount += 1
                 cur.execute(sql)
                 if cur.rowcount == 0:
                     raise Exception('Error: visit t_resource_type failed when id = {0}!!!'.format(rtId))
@@ -408,6 +3103,7 @@ class RoleManager(object):
             cur = self.db.cursor()
             if resourceTypeId is not None:
                 sql = '''SELECT * FROM t_permission WHERE resource_type_id={0};'''.format(resourceTypeId)
+                self.queryCount += 1
                 cur.execute(sql)
                 if cur.rowcount == 0:
                     raise Exception('Error: visit t_permission failed when resourcetype id:{0}!!!'.format(resourceTypeId))
@@ -436,6 +3132,7 @@ class RoleManager(object):
         try:
             permissionTable = {}
             sql = '''SELECT * FROM t_permission'''
+            self.queryCount += 1
             cur.execute(sql)
             if cur.rowcount == 0:
                 raise Exception('Error: visit t_permission failed!!!')
@@ -455,6 +3152,7 @@ class RoleManager(object):
             cur = self.db.cursor()
             resourceTable = {}
             sql = '''SELECT * FROM t_resource'''
+            self.queryCount += 1
             cur.execute(sql)
             if cur.rowcount == 0:
                 raise Exception('Error: visit t_resource failed!!!')
@@ -462,6 +3160,7 @@ class RoleManager(object):
             for row in cur.fetchall():
                 resourceTable[row[0]] = row
                 tmpDict[row[1]] = row[0]
+            self.countRedis('hmset')
             self.redisdb.hmset('ResourceTable', tmpDict)
             return resourceTable
         except Exception as e:
@@ -472,18 +3171,37 @@ class RoleManager(object):
             cur.close()
 
     def getRedisResourceTable(self, resourceName=None):
+        # names this process knows are answered locally, as the string redis would return;
+        # redis only sees the misses
         if resourceName:
-            if self.redisdb.hexists('ResourceTable', resourceName):
-                return self.redisdb.hget('ResourceTable', resourceName)
-            else:
+            resId = self.resolveNames([resourceName])[0]
+            if resId is None:
                 return False
+            return str(resId)
         else:
+            self.countRedis('hgetall')
             return self.redisdb.hgetall('ResourceTable')
 
+    def resolveNames(self, names):
+        # resource ids in the order of names, None for unknown names; one HMGET for the misses
+        resourceNames = self.resourceNames
+        ids = [resourceNames.get(name) for name in names]
+        misses = [name for name, resId in zip(names, ids) if resId is None]
+        if misses:
+            found = {}
+            self.countRedis('hmget')
+            for name, value in zip(misses, self.redisdb.hmget('ResourceTable', misses)):
+                if value is not None:
+                    # registered by another worker since this one loaded
+                    found[name] = resourceNames[name] = int(value)
+            ids = [found.get(name) if resId is None else resId for name, resId in zip(names, ids)]
+        return ids
+
     def getRoleTable(self):
         try:
             cur = self.db.cursor()
             sql = '''SELECT * FROM t_role'''
+            self.queryCount += 1
             cur.execute(sql)
             if cur.rowcount == 0:
                 raise Exception('Error: visit t_role failed!!!')
@@ -499,6 +3217,7 @@ class RoleManager(object):
         try:
             cur = self.db.cursor()
             sql = '''SELECT * FROM t_role_memberof WHERE child_role_id={0}'''.format(childRoleId)
+            self.queryCount += 1
             cur.execute(sql)
             if cur.rowcount == 0:
                 raise Exception('Error: visit t_role_memberOf failed!!! when id = {0}'.format(childRoleId))
@@ -514,6 +3233,7 @@ class RoleManager(object):
         try:
             cur = self.db.cursor()
             sql = '''SELECT resource_id FROM t_group_resource WHERE group_id={0}'''.format(groupId)
+            self.queryCount += 1
             cur.execute(sql)
             if cur.rowcount == 0:
                 raise Exception('Message: visit t_group_resource is empty when groupid={0}!!!'.format(groupId))
@@ -531,6 +3251,7 @@ class RoleManager(object):
             cur = self.db.cursor()
             sql = '''SELECT resource_id FROM t_role_permission_resource
                      WHERE role_id={0}'''.format(roleId)
+            self.queryCount += 1
             cur.execute(sql)
             tmpRes = cur.fetchall()
             if not tmpRes:
@@ -540,6 +3261,7 @@ class RoleManager(object):
 
                 sql = '''SELECT permission_id FROM t_role_permission_resource
                              WHERE role_id={0} AND resource_id={1}'''.format(roleId, i)
+                self.queryCount += 1
                 cur.execute(sql)
                 tmpPerms = map(lambda x: x[0], cur.fetchall())
                 resourcePermissions[i] = tmpPerms
@@ -551,13 +3273,148 @@ class RoleManager(object):
         finally:
             cur.close()
 
+    def streamTable(self, sql, cursorName):
+        # server-side cursor: rows arrive in chunks of bulkItersize instead of one fetchall
+        cur = self.db.cursor(name=cursorName)
+        try:
+            cur.itersize = self.bulkItersize
+            self.queryCount += 1
+            cur.execute(sql)
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+
+    def getAllRoleMemberOfTable(self):
+        try:
+            memberOf = {}
+            sql = '''SELECT * FROM t_role_memberof'''
+            for cid, pid in self.streamTable(sql, 'rms_role_memberof'):
+                memberOf.setdefault(cid, []).append(pid)
+            return memberOf
+        except Exception as e:
+            print e
+            self.db.rollback()
+            return False
+
+    def getAllGroupResourceTable(self):
+        try:
+            groupMembers = {}
+            sql = '''SELECT group_id, resource_id FROM t_group_resource'''
+            for groupId, resId in self.streamTable(sql, 'rms_group_resource'):
+                groupMembers.setdefault(groupId, []).append(resId)
+            return groupMembers
+        except Exception as e:
+            print e
+            self.db.rollback()
+            return False
+
+    def getAllRolePermissionResourceTable(self):
+        try:
+            rolePermissions = {}
+            sql = '''SELECT role_id, resource_id, permission_id FROM t_role_permission_resource'''
+            for roleId, resId, permId in self.streamTable(sql, 'rms_role_permission_resource'):
+                rolePermissions.setdefault(roleId, {}).setdefault(resId, []).append(permId)
+            return rolePermissions
+        except Exception as e:
+            print e
+            self.db.rollback()
+            return False
+
+class AsyncRoleManager(RoleManager):
+    # RoleManager for event-loop services. The blocking psycopg2 and redis calls run on a
+    # thread pool and come back as concurrent.futures.Future objects, which asyncio code
+    # awaits with asyncio.wrap_future:
+    #
+    #     manager = await asyncio.wrap_future(AsyncRoleManager.create(connect, redisdb))
+    #     results = await asyncio.wrap_future(manager.hasPermissionManyAsync(checks))
+    #
+    # connect() must return a new connection per call: every table loader gets its own,
+    # so the seven loads run at the same time. Loader connections are closed afterwards.
+    loaders = ('getPermissionTable', 'getRoleTable', 'getResourceTable', 'getResourceTypeTable',
+               'getAllRoleMemberOfTable', 'getAllGroupResourceTable', 'getAllRolePermissionResourceTable')
+
+    def __init__(self, connect, redisdb, workers=7):
+        if ThreadPoolExecutor is None:
+            raise Exception('Error: AsyncRoleManager needs concurrent.futures (pip install futures on python 2)')
+        self.initState(None, redisdb)
+        self.connect = connect
+        self.executor = ThreadPoolExecutor(workers)
+        self.loadStats = None
+
+    @classmethod
+    def create(cls, connect, redisdb, workers=7):
+        return cls(connect, redisdb, workers).load()
+
+    def load(self):
+        # the finishing task is queued behind the loaders, so it never waits on a loader
+        # that has no worker left to run it
+        startTime = time.time()
+        loads = dict((name, self.executor.submit(self.runLoader, name)) for name in self.loaders)
+        return self.executor.submit(self.finishLoad, loads, startTime)
+
+    def runLoader(self, name):
+        db = self.connect()
+        loader = RoleManager.__new__(RoleManager)
+        loader.initState(db, self.redisdb)
+        try:
+            return getattr(loader, name)(), loader.queryCount
+        finally:
+            if hasattr(db, 'close'):
+                db.close()
+
+    def finishLoad(self, loads, startTime):
+        tables = {}
+        for name, future in loads.items():
+            tables[name], queries = future.result()
+            self.queryCount += queries
+            if tables[name] is False:
+                raise Exception('Error: AsyncRoleManager load failed in {0}'.format(name))
+        self.db = self.connect()
+        self.permissionTable = tables["getPermissionTable"]
+        self.resourceTable = tables["getResourceTable"]
+        with self.batch():
+            self.buildGraph(tables["getResourceTypeTable"], tables["getRoleTable"],
+                            tables["getAllRoleMemberOfTable"] or {},
+                            tables["getAllGroupResourceTable"] or {},
+                            tables["getAllRolePermissionResourceTable"] or {})
+        self.loadStats = {
+            "mode": "async",
+            "queries": self.queryCount,
+            "seconds": time.time() - startTime
+        }
+        return self
+
+    def hasPermissionAsync(self, roleId, resourceId, permission):
+        return self.executor.submit(self.hasPermission, roleId, resourceId, permission)
+
+    def hasPermissionManyAsync(self, checks):
+        return self.executor.submit(self.hasPermissionMany, checks)
+
+    def checkManyAsync(self, roleIds, resourceIds, permissions):
+        return self.executor.submit(self.checkMany, roleIds, resourceIds, permissions)
+
+    def getRedisResourceTableAsync(self, resourceName=None):
+        return self.executor.submit(self.getRedisResourceTable, resourceName)
+
+    def resolveNamesAsync(self, names):
+        return self.executor.submit(self.resolveNames, names)
+
+    def close(self):
+        self.stopSync()
+        self.executor.shutdown(wait=True)
+
+
 if __name__ == '__main__':
+    import psycopg2
+
     conn = psycopg2.connect(database="acl2", user="postgres", password="powerup", host="127.0.0.1", port="5432")
     import redis
 
     r = redis.StrictRedis(host='127.0.0.1', port=6379, db=1, password='powerup-redis')
 
-    RM = RoleManager(conn,r)
+    RM = RoleManager(conn, r, bulkLoad=True)
+    print RM.getLoadStats()
     a = RM.allRoles[1].hasPermission(75,'ADD_RESOURCE_TYPE')
     print a
 
@@ -0,0 +1,34 @@
+"""Throughput of RoleManager.exportPolicy as the process pool grows.
+
+The mixed workload scenario is loaded once and exported with 1, 2, 4 ... processes up to
+maxProcesses; rows per second should grow close to linearly until the cores run out.
+
+    python bench/export.py [roles] [resources] [maxProcesses]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import RMS
+import workload
+from fakes import FakeDB, FakeRedis
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:4]]
+    nRoles = args[0] if len(args) > 0 else 4000
+    nResources = args[1] if len(args) > 1 else 8000
+    maxProcesses = args[2] if len(args) > 2 else multiprocessing.cpu_count()
+    manager = RMS.RoleManager(FakeDB(workload.scenarioTables('mixed', nRoles, nResources)), FakeRedis(),
+                              bulkLoad=True)
+    path = os.path.join(tempfile.mkdtemp(), 'audit.csv')
+    processes = 1
+    while processes <= maxProcesses:
+        result = manager.exportPolicy(path, processes=processes)
+        print('processes: {0:2d} rows: {1:10d} seconds: {2:8.2f} rows/s: {3:10.0f}'.format(
+            result["processes"], result["rows"], result["seconds"], result["rowsPerSecond"]))
+        processes *= 2
+    os.remove(path)
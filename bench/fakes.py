@@ -0,0 +1,220 @@
+"""In-memory stand-ins for the psycopg2 connection and the redis client RoleManager uses.
+
+Only the queries and commands RMS.py issues are understood, which is enough to load a
+RoleManager from plain Python tables in the benchmarks:
+
+    tables = {"t_role": [(1, 'admin', True)], "t_role_memberof": [(1, 1)], ...}
+    manager = RMS.RoleManager(FakeDB(tables), FakeRedis(), bulkLoad=True)
+"""
+import re
+
+schema = {
+    "t_permission": ('id', 'name', 'description', 'resource_type_id'),
+    "t_resource_type": ('id', 'name', 'description'),
+    "t_resource": ('id', 'name', 'resource_type_id', 'content_id', 'is_group'),
+    "t_role": ('id', 'name', 'is_login'),
+    "t_role_memberof": ('child_role_id', 'parent_role_id'),
+    "t_group_resource": ('group_id', 'resource_id'),
+    "t_role_permission_resource": ('role_id', 'resource_id', 'permission_id'),
+}
+
+selectPattern = re.compile(r'SELECT (.+?) FROM (\w+)(?: t)?(?: WHERE (.+))?$')
+insertPattern = re.compile(r'INSERT INTO (\w+) \((.+?)\) VALUES')
+deletePattern = re.compile(r'DELETE FROM (\w+) WHERE (.+)$')
+conditionPattern = re.compile(r'(\w+)=(\d+)')
+inPattern = re.compile(r'(\w+) IN \(([\d, ]*)\)')
+
+
+class FakeCursor(object):
+    def __init__(self, db, name=None):
+        self.db = db
+        self.name = name
+        self.itersize = 2000
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, sql, params=None):
+        self.db.queries += 1
+        sql = ' '.join(sql.split()).rstrip(';')
+        if sql.startswith('INSERT') or sql.startswith('DELETE'):
+            return self.write(sql, [params])
+        match = selectPattern.match(sql)
+        if match is None:
+            raise Exception('FakeDB: unsupported sql: {0}'.format(sql))
+        columns, table, where = match.groups()
+        names = schema[table]
+        rows = self.db.tables.get(table, [])
+        if where and inPattern.match(where):
+            column, values = inPattern.match(where).groups()
+            position = names.index(column)
+            rows = [row for value in set(int(v) for v in values.split(',') if v.strip())
+                    for row in self.db.lookup(table, position, value)]
+        elif where:
+            conditions = conditionPattern.findall(where)
+            column, value = conditions[0]
+            rows = self.db.lookup(table, names.index(column), int(value))
+            for column, value in conditions[1:]:
+                position = names.index(column)
+                rows = [row for row in rows if row[position] == int(value)]
+        if columns.startswith('count(*)'):
+            # getTableFingerprint: row count and an order independent sum of row hashes
+            rows = [(len(rows), sum(hash(repr(tuple(row))) % 1000003 for row in rows))]
+        elif columns != '*':
+            picked = [names.index(column.strip()) for column in columns.split(',')]
+            rows = [tuple(row[i] for i in picked) for row in rows]
+        self.rows = [tuple(row) for row in rows]
+        self.rowcount = len(self.rows)
+
+    def executemany(self, sql, paramsList):
+        self.db.queries += 1
+        self.write(' '.join(sql.split()).rstrip(';'), paramsList)
+
+    def write(self, sql, paramsList):
+        # the statements WriteBehind issues: INSERT ... ON CONFLICT DO NOTHING, and DELETE
+        # keyed on every column (link tables) or on "id = ANY(%s)"
+        match = insertPattern.match(sql)
+        if match:
+            table = self.db.tables.setdefault(match.group(1), [])
+            existing = set(table)
+            for params in paramsList:
+                row = tuple(params)
+                if row not in existing:
+                    existing.add(row)
+                    table.append(row)
+            self.rowcount = len(paramsList)
+            return
+        match = deletePattern.match(sql)
+        if match is None:
+            raise Exception('FakeDB: unsupported sql: {0}'.format(sql))
+        tableName, where = match.groups()
+        names = schema[tableName]
+        before = len(self.db.tables.get(tableName, []))
+        if where.endswith('= ANY(%s)'):
+            column = names.index(where.split()[0])
+            doomed = set(paramsList[0][0])
+            self.db.tables[tableName] = [row for row in self.db.tables.get(tableName, [])
+                                         if row[column] not in doomed]
+        else:
+            keys = [names.index(condition.split('=')[0].strip()) for condition in where.split(' AND ')]
+            doomed = set(tuple(params) for params in paramsList)
+            self.db.tables[tableName] = [row for row in self.db.tables.get(tableName, [])
+                                         if tuple(row[i] for i in keys) not in doomed]
+        self.rowcount = before - len(self.db.tables[tableName])
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def __iter__(self):
+        rows, self.rows = self.rows, []
+        return iter(rows)
+
+    def close(self):
+        pass
+
+
+class FakeDB(object):
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = 0
+        self.notifies = []
+        self.indexes = {}
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def lookup(self, table, position, value):
+        # rows whose column equals value, through a hash index rebuilt when the table changes
+        rows = self.tables.get(table, [])
+        key = (table, position)
+        cached = self.indexes.get(key)
+        if cached is None or cached[0] is not rows or cached[1] != len(rows):
+            index = {}
+            for row in rows:
+                index.setdefault(row[position], []).append(row)
+            cached = self.indexes[key] = (rows, len(rows), index)
+        return cached[2].get(value, [])
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+
+    def hset(self, key, field, value):
+        self.calls += 1
+        self.data.setdefault(key, {})[field] = value
+
+    def hmset(self, key, mapping):
+        self.calls += 1
+        self.data.setdefault(key, {}).update(mapping)
+
+    def hdel(self, key, *fields):
+        self.calls += 1
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def hexists(self, key, field):
+        self.calls += 1
+        return field in self.data.get(key, {})
+
+    def hget(self, key, field):
+        self.calls += 1
+        return self.data.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        self.calls += 1
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def hgetall(self, key):
+        self.calls += 1
+        return dict(self.data.get(key, {}))
+
+    def get(self, key):
+        self.calls += 1
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.calls += 1
+        self.data[key] = str(value).encode()
+
+    def incr(self, key):
+        self.calls += 1
+        self.data[key] = int(self.data.get(key) or 0) + 1
+        return self.data[key]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, redisdb):
+        self.redisdb = redisdb
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        # a pipeline is a single round trip however many commands it carries
+        commands, self.commands = self.commands, []
+        calls = self.redisdb.calls
+        results = [getattr(self.redisdb, name)(*args, **kwargs) for name, args, kwargs in commands]
+        self.redisdb.calls = calls + 1
+        return results
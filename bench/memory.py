@@ -0,0 +1,105 @@
+"""Bytes per role, per resource and per grant of the RMS object model.
+
+Builds a synthetic policy through the public Role/Resource API, without a database,
+and measures it by walking the object graph with sys.getsizeof.
+
+    python bench/memory.py [roles] [resources] [grantsPerRole]
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import RMS
+
+
+def slotNames(cls):
+    names = []
+    for klass in cls.__mro__:
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(slots)
+    return names
+
+
+def deepSize(roots, exclude=()):
+    seen = set(id(obj) for obj in exclude)
+    stack = list(roots)
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+        for name in slotNames(type(obj)):
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return total
+
+
+def buildPolicy(nRoles, nResources, grantsPerRole, seed=0):
+    rnd = random.Random(seed)
+    resourceType = RMS.ResourceType(1, 'doc')
+    resourceType.addPermission({1: 'READ', 2: 'EDIT', 3: 'DELETE'})
+    resources = [RMS.Resource(i, 'res%d' % i, resourceType, None, 0) for i in range(nResources)]
+    roles = []
+    for i in range(nRoles):
+        role = RMS.Role(i, 'role%d' % i, i % 2 == 0)
+        role.addParent(role)
+        if i:
+            role.addParent(roles[rnd.randrange(i)])
+        roles.append(role)
+    return resourceType, resources, roles, rnd
+
+
+def measure(nRoles=20000, nResources=20000, grantsPerRole=3):
+    resourceType, resources, roles, rnd = buildPolicy(nRoles, nResources, grantsPerRole)
+    shared = [resourceType]
+    if hasattr(RMS, 'EMPTY'):
+        shared.append(RMS.EMPTY)
+    resourceBytes = deepSize(resources, shared)
+    roleBytes = deepSize(roles, shared + resources)
+    grants = 0
+    for role in roles:
+        for res in rnd.sample(resources, grantsPerRole):
+            if role.addResource(res, [rnd.choice([1, 2, 3])]):
+                grants += 1
+    grantBytes = deepSize(roles, shared + resources) - roleBytes
+    # the effective indexes live in the policy snapshot of the RoleManager the roles belong
+    # to; the manager and the graph itself are excluded so only the indexes are counted
+    manager = RMS.RoleManager.__new__(RMS.RoleManager)
+    manager.initState(None, None)
+    with manager.batch():
+        for role in roles:
+            manager.registRole(role)
+    policy = manager.getPolicy()
+    for role in roles:
+        policy.getIndex(role.getId())
+    indexBytes = deepSize([policy.indexes], shared + resources + roles + [manager])
+    return {
+        "roles": nRoles,
+        "resources": nResources,
+        "grants": grants,
+        "bytesPerRole": roleBytes / float(nRoles),
+        "bytesPerResource": resourceBytes / float(nResources),
+        "bytesPerGrant": grantBytes / float(max(grants, 1)),
+        "indexBytesPerRole": indexBytes / float(nRoles),
+    }
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:4]]
+    result = measure(*args)
+    print('roles: {0} resources: {1} grants: {2}'.format(result["roles"], result["resources"], result["grants"]))
+    for key in ("bytesPerRole", "bytesPerResource", "bytesPerGrant", "indexBytesPerRole"):
+        print('{0:>18}: {1:10.1f}'.format(key, result[key]))
@@ -0,0 +1,138 @@
+"""Benchmark suite: load time, query count, hasPermission latency and memory per scenario.
+
+Each scenario from workload.py is loaded into a RoleManager through the FakeDB/FakeRedis
+stand-ins, so no Postgres or redis is needed. Results are written as JSON, keyed by
+scenario, together with the commit they were measured on, so two runs can be diffed:
+
+    python bench/run.py [--roles N] [--resources N] [--checks N] [--scenario name ...] [--out file]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import RMS
+import workload
+from fakes import FakeDB, FakeRedis
+from memory import deepSize
+
+# the per-role loader issues several queries per role; larger runs only time it for bulk
+PER_ROLE_LOAD_LIMIT = 2000
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def measureLoad(tables, bulkLoad):
+    db = FakeDB(tables)
+    startTime = time.time()
+    manager = RMS.RoleManager(db, FakeRedis(), bulkLoad=bulkLoad)
+    return manager, {"seconds": time.time() - startTime, "queries": db.queries}
+
+
+def measureChecks(manager, nChecks, seed=0):
+    rnd = random.Random(seed)
+    roleIds = list(manager.allRoles)
+    resourceIds = list(manager.allResources)
+    permissions = [name for permId, name in sorted(workload.PERMISSIONS.items())]
+    # the first pass fills the per-role indexes of the snapshot, the checks after it are timed
+    startTime = time.time()
+    for roleId in roleIds:
+        manager.allRoles[roleId].getPermissionIndex()
+    indexSeconds = time.time() - startTime
+    # half of the checks aim at resources the role was granted something on, so that
+    # hits are not drowned in misses
+    checks = []
+    for i in range(nChecks):
+        roleId = rnd.choice(roleIds)
+        granted = list(manager.allRoles[roleId].getPermissionIndex()) if i % 2 else None
+        checks.append((roleId, rnd.choice(granted or resourceIds), rnd.choice(permissions)))
+    hits = []
+    misses = []
+    clock = time.time
+    for roleId, resourceId, permission in checks:
+        role = manager.allRoles[roleId]
+        startTime = clock()
+        allowed = role.hasPermission(resourceId, permission)
+        elapsed = clock() - startTime
+        (hits if allowed else misses).append(elapsed)
+    result = {"indexBuildSeconds": indexSeconds, "hits": len(hits), "misses": len(misses)}
+    for label, samples in (("hit", hits), ("miss", misses)):
+        for name, fraction in (("p50", 0.5), ("p99", 0.99)):
+            value = percentile(samples, fraction)
+            result["{0}{1}Micros".format(label, name.capitalize())] = None if value is None else value * 1e6
+    return result
+
+
+def measureMemory(manager):
+    shared = [manager, RMS.EMPTY, manager.allResourceTypes]
+    graphBytes = deepSize([manager.allRoles, manager.allResources], shared)
+    indexBytes = deepSize([manager.getPolicy().indexes], shared + list(manager.allResources.values()))
+    return {
+        "graphBytes": graphBytes,
+        "indexBytes": indexBytes,
+        "bytesPerRole": (graphBytes + indexBytes) / float(max(len(manager.allRoles), 1)),
+    }
+
+
+def runScenario(name, nRoles, nResources, nChecks):
+    tables = workload.scenarioTables(name, nRoles, nResources)
+    result = {
+        "roles": nRoles,
+        "resources": len(tables["t_resource"]),
+        "edges": len(tables["t_role_memberof"]),
+        "groupMembers": len(tables["t_group_resource"]),
+        "grants": len(tables["t_role_permission_resource"]),
+    }
+    manager, result["bulkLoad"] = measureLoad(tables, True)
+    if nRoles <= PER_ROLE_LOAD_LIMIT:
+        result["perRoleLoad"] = measureLoad(tables, False)[1]
+    result["checks"] = measureChecks(manager, nChecks)
+    result["memory"] = measureMemory(manager)
+    return result
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='RMS synthetic workload benchmarks')
+    parser.add_argument('--roles', type=int, default=2000)
+    parser.add_argument('--resources', type=int, default=5000)
+    parser.add_argument('--checks', type=int, default=20000)
+    parser.add_argument('--scenario', action='append', choices=sorted(workload.scenarios))
+    parser.add_argument('--out', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    report = {
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "scenarios": {},
+    }
+    for name in args.scenario or sorted(workload.scenarios):
+        report["scenarios"][name] = runScenario(name, args.roles, args.resources, args.checks)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
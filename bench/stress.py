@@ -0,0 +1,139 @@
+"""Concurrent permission checks while the policy is being rewritten.
+
+Reader threads check pairs of grants that a writer thread always flips together inside
+RoleManager.batch(): role 0 can READ either resource A or resource B, never both and never
+neither, and every other role inherits that from role 0. A reader that sees both or
+neither within one policy snapshot counts an error. The writer also registers and removes
+roles so that the role graph itself changes under the readers.
+
+Every thread count runs twice, the second time with the decision cache enabled (on
+FakeRedis), where reader threads share its LRU with the writer bumping the version. Once
+the threads stop, answers served through the cache are compared with the policy; any
+that differ count as stale.
+
+    python bench/stress.py [roles] [seconds] [maxThreads]
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import RMS
+from fakes import FakeDB, FakeRedis
+
+RESOURCE_A = 1
+RESOURCE_B = 2
+READ = 1
+
+
+def buildTables(nRoles, seed=0):
+    rnd = random.Random(seed)
+    memberOf = [(0, 0)]
+    for rid in range(1, nRoles):
+        memberOf.append((rid, rid))
+        memberOf.append((rid, rnd.randrange(rid)))
+    return {
+        "t_resource_type": [(1, 'doc', None)],
+        "t_permission": [(READ, 'READ', None, 1), (2, 'EDIT', None, 1)],
+        "t_resource": [(RESOURCE_A, 'a', 1, None, False), (RESOURCE_B, 'b', 1, None, False)],
+        "t_role": [(rid, 'role%d' % rid, False) for rid in range(nRoles)],
+        "t_role_memberof": memberOf,
+        "t_group_resource": [],
+        "t_role_permission_resource": [(0, RESOURCE_A, READ)],
+    }
+
+
+def reader(manager, nRoles, stop, counts, seed):
+    rnd = random.Random(seed)
+    checks = errors = 0
+    try:
+        while not stop.is_set():
+            roleId = rnd.randrange(nRoles)
+            policy = manager.getPolicy()
+            if policy.hasPermission(roleId, RESOURCE_A, 'READ') == policy.hasPermission(roleId, RESOURCE_B, 'READ'):
+                errors += 1
+            manager.hasPermissionMany([(rnd.randrange(nRoles + 10), RESOURCE_A, 'READ'),
+                                       (rnd.randrange(nRoles), RESOURCE_B, 'READ')])
+            checks += 4
+    except Exception as e:
+        counts.append((checks, errors, repr(e)))
+        return
+    counts.append((checks, errors, None))
+
+
+def writer(manager, nRoles, stop, writes):
+    resources = manager.allResources
+    owner = manager.allRoles[0]
+    extra = nRoles
+    while not stop.is_set():
+        with manager.batch():
+            if RESOURCE_A in owner.getResources():
+                owner.removeResource(resources[RESOURCE_A])
+                owner.addResource(resources[RESOURCE_B], [READ])
+            else:
+                owner.removeResource(resources[RESOURCE_B])
+                owner.addResource(resources[RESOURCE_A], [READ])
+        role = RMS.Role(extra, 'extra%d' % extra, False)
+        role.addParent(role)
+        role.addParent(owner)
+        manager.registRole(role)
+        manager.removeRole(role)
+        extra += 1
+        writes[0] += 1
+
+
+def run(manager, nRoles, nThreads, seconds):
+    stop = threading.Event()
+    counts = []
+    writes = [0]
+    threads = [threading.Thread(target=reader, args=(manager, nRoles, stop, counts, i)) for i in range(nThreads)]
+    threads.append(threading.Thread(target=writer, args=(manager, nRoles, stop, writes)))
+    startTime = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - startTime
+    policy = manager.getPolicy()
+    stale = 0
+    for roleId in range(nRoles):
+        for resourceId in (RESOURCE_A, RESOURCE_B):
+            if manager.hasPermission(roleId, resourceId, 'READ') != policy.hasPermission(roleId, resourceId, 'READ'):
+                stale += 1
+    return {
+        "threads": nThreads,
+        "cache": manager.decisionCache is not None,
+        "checksPerSecond": sum(count[0] for count in counts) / elapsed,
+        "writesPerSecond": writes[0] / elapsed,
+        "errors": sum(count[1] for count in counts),
+        "stale": stale,
+        "exceptions": [count[2] for count in counts if count[2] is not None],
+    }
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:4]]
+    nRoles = args[0] if len(args) > 0 else 1000
+    seconds = args[1] if len(args) > 1 else 2
+    maxThreads = args[2] if len(args) > 2 else 8
+    manager = RMS.RoleManager(FakeDB(buildTables(nRoles)), FakeRedis(), bulkLoad=True)
+    nThreads = 1
+    while nThreads <= maxThreads:
+        for cache in (False, True):
+            if cache:
+                manager.enableDecisionCache(lruSize=nRoles)
+            else:
+                manager.disableDecisionCache()
+            result = run(manager, nRoles, nThreads, seconds)
+            print('threads: {0:2d} cache: {1:d} checks/s: {2:10.0f} writes/s: {3:8.0f} errors: {4} stale: {5} '
+                  'exceptions: {6}'.format(result["threads"], result["cache"], result["checksPerSecond"],
+                                           result["writesPerSecond"], result["errors"], result["stale"],
+                                           len(result["exceptions"])))
+            for exception in sorted(set(result["exceptions"])):
+                print('    {0}'.format(exception))
+        nThreads *= 2
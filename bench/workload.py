@@ -0,0 +1,90 @@
+"""Synthetic policies for the benchmarks, as plain table rows that FakeDB serves.
+
+Every scenario has a self-loop on each role (so it holds its own grants) and mixes in the
+shapes that make real tenants expensive:
+
+    chain   long inheritance chains (deep parent trees)
+    dag     six layers of roles with two or three parents each, full of diamonds
+    groups  grants on large ResGroups, one level of nesting
+    skewed  a few roles hold most grants (zipf distributed grant counts)
+    mixed   all of the above at once
+"""
+import random
+
+READ, EDIT, DELETE, ADMIN = 1, 2, 3, 4
+PERMISSIONS = {READ: 'READ', EDIT: 'EDIT', DELETE: 'DELETE', ADMIN: 'ADMIN'}
+
+scenarios = {
+    "chain": {"depth": 300, "layers": 0, "groupCount": 0, "skew": 0.0},
+    "dag": {"depth": 0, "layers": 6, "groupCount": 0, "skew": 0.0},
+    "groups": {"depth": 0, "layers": 6, "groupCount": 20, "skew": 0.0},
+    "skewed": {"depth": 0, "layers": 6, "groupCount": 0, "skew": 1.2},
+    "mixed": {"depth": 100, "layers": 6, "groupCount": 20, "skew": 1.2},
+}
+
+
+def zipfCounts(n, total, skew, rnd):
+    # grant counts per role summing to about total, the heaviest roles in random places
+    if not skew:
+        return [total // n] * n
+    weights = [1.0 / (rank + 1) ** skew for rank in range(n)]
+    scale = total / sum(weights)
+    counts = [max(1, int(weight * scale)) for weight in weights]
+    rnd.shuffle(counts)
+    return counts
+
+
+def buildTables(nRoles=2000, nResources=5000, grantsPerRole=5, depth=0, layers=6,
+                groupCount=0, skew=0.0, seed=0):
+    rnd = random.Random(seed)
+    roles = [(rid, 'role%d' % rid, rid % 3 == 0) for rid in range(nRoles)]
+    memberOf = [(rid, rid) for rid in range(nRoles)]
+    # the first nChain roles form chains of the given depth, the rest are layered into a DAG
+    nChain = min(nRoles, depth * max(1, nRoles // (4 * depth))) if depth else 0
+    for rid in range(nChain):
+        if rid % depth:
+            memberOf.append((rid, rid - 1))
+    if layers:
+        layerWidth = max(3, (nRoles - nChain) // layers)
+        for rid in range(nChain + layerWidth, nRoles):
+            layerStart = nChain + ((rid - nChain) // layerWidth - 1) * layerWidth
+            for pid in rnd.sample(range(layerStart, layerStart + layerWidth), rnd.choice((2, 3))):
+                memberOf.append((rid, pid))
+
+    resources = [(resId, 'res%d' % resId, 1, None, False) for resId in range(nResources)]
+    groupMembers = []
+    groupIds = []
+    if groupCount:
+        # one in ten groups nests another, the rest hold plain resources
+        groupSize = max(1, nResources // (2 * groupCount))
+        for g in range(groupCount):
+            groupId = nResources + g
+            resources.append((groupId, 'group%d' % g, 1, None, True))
+            groupIds.append(groupId)
+            for resId in rnd.sample(range(nResources), groupSize):
+                groupMembers.append((groupId, resId))
+            if g % 10 == 1:
+                groupMembers.append((groupId, groupId - 1))
+
+    grants = []
+    for rid, count in enumerate(zipfCounts(nRoles, grantsPerRole * nRoles, skew, rnd)):
+        targets = rnd.sample(range(nResources), min(count, nResources))
+        if groupIds and rnd.random() < 0.2:
+            targets.append(rnd.choice(groupIds))
+        for resId in targets:
+            for permId in rnd.sample((READ, EDIT, DELETE), rnd.choice((1, 1, 2))):
+                grants.append((rid, resId, permId))
+
+    return {
+        "t_resource_type": [(1, 'doc', 'documents')],
+        "t_permission": [(permId, name, None, 1) for permId, name in sorted(PERMISSIONS.items())],
+        "t_resource": resources,
+        "t_role": roles,
+        "t_role_memberof": memberOf,
+        "t_group_resource": groupMembers,
+        "t_role_permission_resource": grants,
+    }
+
+
+def scenarioTables(name, nRoles=2000, nResources=5000, grantsPerRole=5, seed=0):
+    return buildTables(nRoles, nResources, grantsPerRole, seed=seed, **scenarios[name])
@@ -0,0 +1,31 @@
+"""Shared setup for the tests: RMS.py and the bench fakes on sys.path, and a small policy.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path[:0] = [root, os.path.join(root, 'bench')]
+
+import RMS
+from fakes import FakeDB, FakeRedis
+
+
+def sampleTables():
+    # admin <- staff <- alice, each listing itself as a parent; group 20 holds 11 and 12
+    return {
+        "t_resource_type": [(1, 'doc', 'documents'), (2, 'img', 'images')],
+        "t_permission": [(1, 'READ', None, 1), (2, 'EDIT', None, 1), (3, 'VIEW', None, 2), (4, 'READ', None, 2)],
+        "t_resource": [(10, 'a', 1, None, 0), (11, 'b', 1, None, 0), (12, 'c', 1, None, 0),
+                       (20, 'g', 1, None, 1), (30, 'pic', 2, None, 0)],
+        "t_role": [(1, 'admin', True), (2, 'staff', True), (3, 'alice', True)],
+        "t_role_memberof": [(1, 1), (2, 2), (2, 1), (3, 3), (3, 2)],
+        "t_group_resource": [(20, 11), (20, 12)],
+        "t_role_permission_resource": [(1, 10, 1), (2, 20, 1), (2, 20, 2), (3, 30, 3)],
+    }
+
+
+def loadManager(tables=None, **options):
+    tables = sampleTables() if tables is None else tables
+    return RMS.RoleManager(FakeDB(tables), FakeRedis(), bulkLoad=True, **options)
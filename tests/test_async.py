@@ -0,0 +1,51 @@
+import unittest
+
+from support import RMS, FakeDB, FakeRedis, loadManager, sampleTables
+
+
+@unittest.skipIf(RMS.ThreadPoolExecutor is None, "AsyncRoleManager needs concurrent.futures")
+class AsyncRoleManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = sampleTables()
+        self.redis = FakeRedis()
+        self.connections = []
+        self.manager = RMS.AsyncRoleManager.create(self.connect, self.redis).result(timeout=10)
+
+    def tearDown(self):
+        self.manager.close()
+
+    def connect(self):
+        db = FakeDB(self.tables)
+        self.connections.append(db)
+        return db
+
+    def test_create_loads_on_one_connection_per_loader(self):
+        self.assertIsInstance(self.manager, RMS.AsyncRoleManager)
+        self.assertEqual(self.manager.getLoadStats()["mode"], "async")
+        # the seven loaders, and the manager's own
+        self.assertEqual(len(self.connections), 8)
+        self.assertEqual(sorted(self.manager.allRoles), [1, 2, 3])
+        self.assertEqual(sorted(self.manager.allResources), [10, 11, 12, 20, 30])
+
+    def test_hasPermissionManyAsync(self):
+        reference = loadManager(sampleTables())
+        checks = [(rid, resId, permission) for rid in (1, 2, 3, 99) for resId in (10, 11, 12, 20, 30)
+                  for permission in ('READ', 'EDIT', 'VIEW')]
+        self.assertEqual(self.manager.hasPermissionManyAsync(checks).result(timeout=10),
+                         reference.hasPermissionMany(checks))
+        self.assertTrue(self.manager.hasPermissionAsync(2, 11, 'EDIT').result(timeout=10))
+
+    @unittest.skipIf(RMS.numpy is None, "checkMany needs numpy")
+    def test_checkManyAsync(self):
+        result = self.manager.checkManyAsync([1, 2, 3], [10, 11, 30], ['READ', 'EDIT', 'VIEW']).result(timeout=10)
+        self.assertEqual(result.tolist(), [[True, False, False], [True, True, False], [True, True, True]])
+
+    def test_resolveNamesAsync(self):
+        # 'late' was registered by another worker after this one loaded
+        self.redis.hset('ResourceTable', 'late', 40)
+        self.assertEqual(self.manager.resolveNamesAsync(['a', 'pic', 'late', 'nope']).result(timeout=10),
+                         [10, 30, 40, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
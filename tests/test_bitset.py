@@ -0,0 +1,42 @@
+import unittest
+
+from support import RMS, loadManager
+
+
+@unittest.skipIf(RMS.numpy is None, "checkMany needs numpy")
+class CheckManyTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = loadManager()
+        self.roleIds = [1, 2, 3, 99]
+        self.resourceIds = [10, 11, 12, 20, 30, 77]
+
+    def assertMatchesHasPermission(self):
+        for permission in ('READ', 'EDIT', 'VIEW'):
+            result = self.manager.checkMany(self.roleIds, self.resourceIds, permission)
+            for i, rid in enumerate(self.roleIds):
+                for j, resId in enumerate(self.resourceIds):
+                    self.assertEqual(result[i, j], self.manager.hasPermission(rid, resId, permission),
+                                     (rid, resId, permission))
+
+    def test_rows_follow_changes(self):
+        self.assertMatchesHasPermission()
+        alice = self.manager.allRoles[3]
+        alice.addResource(self.manager.allResources[10], [2])
+        self.assertMatchesHasPermission()
+        self.manager.allResources[20].addMember(self.manager.allResources[10])
+        self.assertMatchesHasPermission()
+        alice.removeParent(self.manager.allRoles[2])
+        self.assertMatchesHasPermission()
+
+    def test_rows_of_unchanged_roles_are_carried_over(self):
+        self.manager.checkMany(self.roleIds, self.resourceIds, 'READ')
+        old = self.manager.getPermissionBitset()
+        self.manager.allRoles[3].addResource(self.manager.allResources[10], [2])
+        new = self.manager.getPermissionBitset()
+        self.assertIsNot(new, old)
+        self.assertIs(new.rows.get(1), old.rows.get(1))
+        self.assertNotIn(3, new.rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from support import RMS, loadManager
+
+
+def chain(n):
+    # r0 <- r1 <- ... <- r(n-1), none of them listing itself as a parent
+    roles = [RMS.Role(i, 'r%d' % i, False) for i in range(n)]
+    for child, parent in zip(roles[1:], roles):
+        child.addParent(parent)
+    return roles
+
+
+class AddParentCycleTest(unittest.TestCase):
+    def test_direct_cycle(self):
+        manager = loadManager()
+        admin, staff = manager.allRoles[1], manager.allRoles[2]
+        self.assertRaises(Exception, admin.addParent, staff)
+        self.assertNotIn(2, admin.getParents())
+
+    def test_cycle_through_roles_without_self_edges(self):
+        manager = loadManager()
+        roles = chain(4)
+        with manager.batch():
+            for role in roles:
+                manager.registRole(role)
+        self.assertRaises(Exception, roles[0].addParent, roles[3])
+        self.assertRaises(Exception, roles[1].addParent, roles[2])
+
+    def test_cycle_without_manager(self):
+        roles = chain(4)
+        self.assertRaises(Exception, roles[0].addParent, roles[3])
+        self.assertTrue(roles[3].addParent(roles[0]))
+
+    def test_self_edge_only_once(self):
+        role = RMS.Role(1, 'solo', False)
+        self.assertTrue(role.addParent(role))
+        self.assertRaises(Exception, role.addParent, role)
+
+    def test_edge_allowed_after_removal(self):
+        manager = loadManager()
+        admin, staff = manager.allRoles[1], manager.allRoles[2]
+        staff.removeParent(admin)
+        self.assertTrue(admin.addParent(staff))
+        self.assertTrue(manager.hasPermission(1, 20, 'READ'))
+        self.assertRaises(Exception, staff.addParent, admin)
+
+    def test_getParentTree_keeps_self_loop_semantics(self):
+        roles = chain(3)
+        self.assertEqual(roles[2].getParentTree(), {})
+        roles[0].addParent(roles[0])
+        self.assertEqual(sorted(roles[2].getParentTree()), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import threading
+import unittest
+
+from support import RMS, FakeDB, FakeRedis, loadManager, sampleTables
+import stress
+
+
+class PositionedSource(RMS.QueueChangeSource):
+    # a feed every worker reads the same events from, numbered as a change log would be
+    def __init__(self):
+        RMS.QueueChangeSource.__init__(self)
+        self.position = 0
+
+    def poll(self, timeout):
+        events = RMS.QueueChangeSource.poll(self, timeout)
+        self.position += len(events)
+        return events
+
+    def getPosition(self):
+        return 'test:{0}'.format(self.position)
+
+
+class DecisionCacheTest(unittest.TestCase):
+    def test_changes_reach_cached_answers(self):
+        manager = loadManager()
+        manager.enableDecisionCache()
+        alice = manager.allRoles[3]
+        self.assertFalse(manager.hasPermission(3, 10, 'EDIT'))
+        alice.addResource(manager.allResources[10], [2])
+        self.assertTrue(manager.hasPermission(3, 10, 'EDIT'))
+        alice.removeResource(manager.allResources[10])
+        self.assertFalse(manager.hasPermission(3, 10, 'EDIT'))
+
+    def test_cached_reads_under_threads(self):
+        nRoles = 200
+        manager = RMS.RoleManager(FakeDB(stress.buildTables(nRoles)), FakeRedis(), bulkLoad=True)
+        manager.enableDecisionCache(lruSize=nRoles)
+        result = stress.run(manager, nRoles, 4, 1)
+        self.assertEqual(result["exceptions"], [])
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual(result["stale"], 0)
+
+    def test_many_readers_share_one_lru(self):
+        manager = loadManager()
+        manager.enableDecisionCache(lruSize=2)
+        checks = [(rid, resId, 'READ') for rid in (1, 2, 3) for resId in (10, 11, 12, 20)]
+        want = [manager.getPolicy().hasPermission(*check) for check in checks]
+        admin, pic = manager.allRoles[1], manager.allResources[30]
+        failures = []
+
+        def read():
+            try:
+                for i in range(300):
+                    if manager.hasPermissionMany(checks) != want:
+                        failures.append('wrong answer')
+                    # a new version, with the same answers for checks
+                    admin.addResource(pic, [4])
+                    admin.removeResource(pic)
+            except Exception as e:
+                failures.append(repr(e))
+
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+
+class SharedVersionTest(unittest.TestCase):
+    # workers on one database and one redis, each with its own copy of the policy
+    def setUp(self):
+        self.tables = sampleTables()
+        self.redis = FakeRedis()
+        self.workers = [RMS.RoleManager(FakeDB(self.tables), self.redis, bulkLoad=True) for i in range(2)]
+        self.sources = [PositionedSource() for worker in self.workers]
+        self.caches = [worker.enableDecisionCache() for worker in self.workers]
+
+    def push(self, table, op, row):
+        self.tables[table].append(row)
+        for source in self.sources:
+            source.push(table, op, row)
+
+    def test_workers_loading_the_same_tables_share_answers(self):
+        first, second = self.workers
+        self.assertEqual(first.getPolicy().version, second.getPolicy().version)
+        self.assertTrue(first.getPolicy().version.startswith('stamp:'))
+        first.hasPermission(2, 11, 'READ')
+        self.assertTrue(second.hasPermission(2, 11, 'READ'))
+        self.assertEqual(self.caches[1].getStats()["redisHits"], 1)
+
+    def test_lagging_worker_files_nothing_under_the_new_version(self):
+        first, second = self.workers
+        self.push('t_role_permission_resource', 'INSERT', (3, 10, 2))
+        first.syncOnce(self.sources[0])
+        self.assertEqual(first.getPolicy().version, 'test:1')
+        # second has not seen the change: its answer stays under its own version
+        self.assertFalse(second.hasPermission(3, 10, 'EDIT'))
+        self.assertTrue(first.hasPermission(3, 10, 'EDIT'))
+        second.syncOnce(self.sources[1])
+        self.assertEqual(second.getPolicy().version, 'test:1')
+        self.assertTrue(second.hasPermission(3, 10, 'EDIT'))
+        self.assertEqual(self.caches[1].getStats()["redisHits"], 1)
+        self.assertEqual(self.redis.get('RMSDecision:version'), None)
+
+    def test_local_change_has_a_version_of_its_own_until_reload(self):
+        first, second = self.workers
+        shared = first.getPolicy().version
+        first.allRoles[3].addResource(first.allResources[10], [2])
+        self.assertTrue(first.getPolicy().version.startswith('local:'))
+        self.assertTrue(first.hasPermission(3, 10, 'EDIT'))
+        self.assertFalse(second.hasPermission(3, 10, 'EDIT'))
+        # never written to the tables: reload undoes it and the shared version is back
+        first.reload()
+        self.assertEqual(first.getPolicy().version, shared)
+        self.assertFalse(first.hasPermission(3, 10, 'EDIT'))
+
+
+if __name__ == '__main__':
+    unittest.main()
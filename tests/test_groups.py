@@ -0,0 +1,26 @@
+import unittest
+
+from support import RMS, loadManager
+
+
+class GroupGrantTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = loadManager()
+        self.doc = self.manager.allResourceTypes[1]
+
+    def test_grant_of_a_group_built_outside_the_manager(self):
+        group = RMS.ResGroup(50, 'adhoc', self.doc)
+        nested = RMS.ResGroup(51, 'nested', self.doc)
+        nested.addMember(RMS.Resource(60, 'loose', self.doc, None, 0))
+        group.addMember(self.manager.allResources[10])
+        group.addMember(nested)
+        self.manager.allRoles[3].addResource(group, [2])
+        for resId in (50, 10, 51, 60):
+            self.assertTrue(self.manager.hasPermission(3, resId, 'EDIT'), resId)
+        self.assertFalse(self.manager.hasPermission(2, 10, 'EDIT'))
+        nested.addMember(RMS.Resource(61, 'late', self.doc, None, 0))
+        self.assertTrue(self.manager.hasPermission(3, 61, 'EDIT'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import random
+import threading
+import unittest
+
+from support import RMS, FakeDB, FakeRedis
+import workload
+
+
+class LazyThreadsTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = workload.scenarioTables('dag', 300, 600)
+        self.full = RMS.RoleManager(FakeDB(self.tables), FakeRedis(), bulkLoad=True)
+        self.lazy = RMS.RoleManager(FakeDB(self.tables), FakeRedis(), lazy=True, maxRoles=30)
+
+    def test_eviction_under_threads(self):
+        self.lazy.enableDecisionCache(lruSize=0)
+        version = self.lazy.getPolicy().version
+        failures = []
+
+        def read(seed):
+            rnd = random.Random(seed)
+            try:
+                for i in range(200):
+                    checks = [(rnd.randrange(300), rnd.randrange(600), 'READ') for j in range(5)]
+                    want = [self.full.getPolicy().hasPermission(*check) for check in checks]
+                    if self.lazy.hasPermissionMany(checks) != want:
+                        failures.append(('wrong answer', checks))
+            except Exception as e:
+                failures.append(repr(e))
+
+        threads = [threading.Thread(target=read, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertGreater(self.lazy.allRoles.getStats()["evictions"], 0)
+        # loading and unloading roles is not a policy change
+        self.assertEqual(self.lazy.getPolicy().version, version)
+
+    def test_change_moves_the_version_on(self):
+        self.lazy.enableDecisionCache()
+        version = self.lazy.getPolicy().version
+        resId = self.tables['t_role_permission_resource'][0][1]
+        self.lazy.hasPermission(self.tables['t_role_permission_resource'][0][0], resId, 'READ')
+        self.assertEqual(self.lazy.getPolicy().version, version)
+        self.assertFalse(self.lazy.hasPermission(299, resId, 'ADMIN'))
+        role = self.lazy.allRoles[299]
+        role.addResource(self.lazy.allResources[resId], [workload.ADMIN])
+        self.assertNotEqual(self.lazy.getPolicy().version, version)
+        self.assertTrue(self.lazy.hasPermission(299, resId, 'ADMIN'))
+
+
+if __name__ == '__main__':
+    unittest.main()
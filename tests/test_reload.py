@@ -0,0 +1,65 @@
+import unittest
+
+from support import RMS, FakeDB, FakeRedis, sampleTables
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = sampleTables()
+        self.db = FakeDB(self.tables)
+        self.manager = RMS.RoleManager(self.db, FakeRedis(), bulkLoad=True)
+
+    def assertMatchesFreshLoad(self):
+        fresh = RMS.RoleManager(FakeDB(dict((name, list(rows)) for name, rows in self.tables.items())),
+                                FakeRedis(), bulkLoad=True)
+        for table in self.manager.entityTables + self.manager.linkTables:
+            self.assertEqual(set(self.manager.liveTableRows(table)), set(fresh.liveTableRows(table)), table)
+        for rid in fresh.allRoles:
+            for resId in fresh.allResources:
+                for permission in ('READ', 'EDIT', 'VIEW'):
+                    self.assertEqual(self.manager.hasPermission(rid, resId, permission),
+                                     fresh.hasPermission(rid, resId, permission), (rid, resId, permission))
+
+    def test_nothing_changed_since_load(self):
+        stats = self.manager.reload()
+        self.assertEqual(stats["changed"], [])
+        self.assertEqual(stats["applied"], 0)
+
+    def test_row_differences_are_applied(self):
+        self.tables["t_role"].append((4, 'bob', True))
+        self.tables["t_role_memberof"] += [(4, 4), (4, 1)]
+        self.tables["t_role_memberof"].remove((3, 2))
+        self.tables["t_role_permission_resource"].append((3, 11, 2))
+        self.tables["t_group_resource"].remove((20, 12))
+        self.tables["t_resource"][0] = (10, 'renamed', 1, None, 0)
+        stats = self.manager.reload()
+        self.assertEqual(stats["failed"], 0)
+        self.assertNotIn('t_permission', stats["changed"])
+        self.assertEqual(self.manager.getRedisResourceTable('renamed'), '10')
+        self.assertMatchesFreshLoad()
+        self.assertEqual(self.manager.reload()["changed"], [])
+
+    def test_resource_changing_type_keeps_grants_on_the_new_object(self):
+        self.tables["t_resource"][0] = (10, 'a', 2, None, 0)
+        self.tables["t_role_permission_resource"][0] = (1, 10, 4)
+        self.assertEqual(self.manager.reload()["failed"], 0)
+        resource = self.manager.allResources[10]
+        self.assertEqual(resource.getResourceType().getId(), 2)
+        for role in self.manager.allRoles.values():
+            resPerms = role.getResources().get(10)
+            if resPerms is not None:
+                self.assertIs(resPerms.getResource(), resource)
+        self.assertTrue(self.manager.hasPermission(3, 10, 'READ'))
+        self.assertMatchesFreshLoad()
+
+    def test_group_becoming_a_resource_drops_its_members(self):
+        self.tables["t_resource"][3] = (20, 'g', 1, None, 0)
+        self.tables["t_group_resource"] = []
+        self.assertEqual(self.manager.reload()["failed"], 0)
+        self.assertNotIsInstance(self.manager.allResources[20], RMS.ResGroup)
+        self.assertFalse(self.manager.hasPermission(2, 11, 'READ'))
+        self.assertMatchesFreshLoad()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from support import RMS, loadManager
+
+
+class UnregisteredParentTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = loadManager()
+        self.alice = self.manager.allRoles[3]
+        # p <- alice, p and its own parent q never registered with the manager
+        self.q = RMS.Role(8, 'q', False)
+        self.q.addParent(self.q)
+        self.p = RMS.Role(9, 'p', False)
+        self.p.addParent(self.p)
+        self.p.addParent(self.q)
+        self.alice.addParent(self.p)
+
+    def test_grant_on_the_parent_reaches_the_manager(self):
+        self.assertFalse(self.manager.hasPermission(3, 10, 'EDIT'))
+        self.p.addResource(self.manager.allResources[10], [2])
+        self.assertTrue(self.manager.hasPermission(3, 10, 'EDIT'))
+        self.p.removeResource(self.manager.allResources[10])
+        self.assertFalse(self.manager.hasPermission(3, 10, 'EDIT'))
+
+    def test_grant_two_levels_up(self):
+        self.q.addResource(self.manager.allResources[10], [2])
+        self.assertTrue(self.manager.hasPermission(3, 10, 'EDIT'))
+        self.assertTrue(self.p.hasPermission(10, 'EDIT'))
+        self.assertFalse(self.manager.hasPermission(2, 10, 'EDIT'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import time
+import unittest
+
+from support import RMS, FakeDB, FakeRedis, sampleTables
+
+
+class QueueSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = sampleTables()
+        self.manager = RMS.RoleManager(FakeDB(self.tables), FakeRedis(), bulkLoad=True)
+        self.source = RMS.QueueChangeSource()
+
+    def change(self, table, op, row, oldRow=None):
+        # what a writer does: change the table, then push the same row
+        rows = self.tables[table]
+        if op != 'INSERT':
+            rows.remove(oldRow or row)
+        if op != 'DELETE':
+            rows.append(row)
+        self.source.push(table, op, row, oldRow)
+
+    def test_rows_are_applied(self):
+        self.change('t_role', 'INSERT', (4, 'bob', True))
+        self.change('t_role_memberof', 'INSERT', (4, 4))
+        self.change('t_role_memberof', 'INSERT', (4, 2))
+        self.change('t_role_permission_resource', 'INSERT', (4, 30, 3))
+        self.change('t_group_resource', 'DELETE', (20, 12))
+        self.assertEqual(self.manager.syncOnce(self.source), 5)
+        self.assertTrue(self.manager.hasPermission(4, 11, 'EDIT'))
+        self.assertTrue(self.manager.hasPermission(4, 30, 'VIEW'))
+        self.assertFalse(self.manager.hasPermission(4, 12, 'READ'))
+        self.assertEqual(self.manager.syncStats["failed"], 0)
+
+    def test_background_sync(self):
+        self.manager.startSync(self.source, timeout=0.05)
+        try:
+            self.change('t_role_permission_resource', 'INSERT', (3, 10, 2))
+            for i in range(100):
+                if self.manager.hasPermission(3, 10, 'EDIT'):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(self.manager.hasPermission(3, 10, 'EDIT'))
+        finally:
+            self.manager.stopSync()
+
+    def test_grants_of_a_resource_changing_type_follow_the_rows(self):
+        self.assertTrue(self.manager.hasPermission(1, 10, 'READ'))
+        self.change('t_resource', 'UPDATE', (10, 'a', 2, None, 0), (10, 'a', 1, None, 0))
+        self.change('t_role_permission_resource', 'DELETE', (1, 10, 1))
+        self.manager.syncOnce(self.source)
+        self.assertFalse(self.manager.hasPermission(1, 10, 'READ'))
+        self.change('t_role_permission_resource', 'INSERT', (1, 10, 4))
+        self.manager.syncOnce(self.source)
+        self.assertTrue(self.manager.hasPermission(1, 10, 'READ'))
+        self.assertEqual(self.manager.syncStats["failed"], 0)
+        self.assertEqual(set(self.manager.liveTableRows('t_role_permission_resource')),
+                         set(self.tables['t_role_permission_resource']))
+
+    def test_failed_change_resyncs_from_the_tables(self):
+        # the table gets one row, the feed a row that cannot be applied
+        self.tables['t_role_permission_resource'].append((3, 11, 2))
+        self.source.push('t_role_permission_resource', 'INSERT', (3, 11, 99))
+        self.manager.syncOnce(self.source)
+        self.assertEqual(self.manager.syncStats, {"failed": 1, "resyncs": 1})
+        self.assertFalse(self.manager.resyncNeeded)
+        self.assertTrue(self.manager.hasPermission(3, 11, 'EDIT'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+
+from support import RMS, FakeRedis
+
+
+class FailingDB(object):
+    # accepts every statement except those carrying a row in poison, or all of them while down
+    def __init__(self):
+        self.poison = set()
+        self.down = False
+        self.written = []
+        # (INSERT | DELETE, row) in the order they were written
+        self.statements = []
+
+    def cursor(self):
+        return FailingCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FailingCursor(object):
+    def __init__(self, db):
+        self.db = db
+
+    def executemany(self, sql, values):
+        for row in values:
+            if self.db.down or row in self.db.poison:
+                raise Exception('cannot write {0}'.format(row))
+        self.db.written.extend(values)
+        self.db.statements.extend((sql.split()[0], row) for row in values)
+
+    def execute(self, sql, params=None):
+        if self.db.down:
+            raise Exception('database down')
+
+    def close(self):
+        pass
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FailingDB()
+        self.writeBehind = RMS.WriteBehind(self.db, FakeRedis(), flushInterval=None, flushSize=1000,
+                                           maxRetries=3, maxPending=20)
+
+    def add(self, rows):
+        for row in rows:
+            self.writeBehind.add('t_role_memberof', 'INSERT', row)
+
+    def test_bad_row_does_not_hold_back_the_batch(self):
+        self.db.poison.add((1, 2))
+        self.add([(i, 2) for i in range(5)])
+        self.assertFalse(self.writeBehind.flush())
+        self.assertEqual(self.writeBehind.getStats()["pending"], 5)
+        self.assertFalse(self.writeBehind.flush())
+        self.assertEqual(sorted(self.db.written), [(0, 2), (2, 2), (3, 2), (4, 2)])
+        self.assertEqual(self.writeBehind.getStats()["pending"], 1)
+
+    def test_row_failing_maxRetries_times_is_dead_lettered(self):
+        self.db.poison.add((1, 2))
+        self.add([(1, 2)])
+        for i in range(3):
+            self.assertFalse(self.writeBehind.flush())
+        self.assertEqual(list(self.writeBehind.deadLetters), [('t_role_memberof', 'INSERT', (1, 2))])
+        stats = self.writeBehind.getStats()
+        self.assertEqual((stats["pending"], stats["dropped"], stats["failures"]), (0, 1, 3))
+        self.assertTrue(self.writeBehind.flush())
+
+    def test_retried_rows_are_written_once_the_database_is_back(self):
+        self.db.down = True
+        self.add([(i, 2) for i in range(5)])
+        self.assertFalse(self.writeBehind.flush())
+        self.db.down = False
+        self.assertTrue(self.writeBehind.flush())
+        self.assertEqual(sorted(self.db.written), [(i, 2) for i in range(5)])
+        self.assertEqual(self.writeBehind.getStats()["pending"], 0)
+
+    def test_retry_superseded_by_a_newer_entry_is_dropped(self):
+        # addParent fails to flush, then removeParent: the edge must not come back
+        self.db.down = True
+        self.writeBehind.add('t_role_memberof', 'INSERT', (5, 2))
+        self.assertFalse(self.writeBehind.flush())
+        self.db.down = False
+        self.writeBehind.add('t_role_memberof', 'DELETE', (5, 2))
+        self.assertTrue(self.writeBehind.flush())
+        self.assertEqual(self.db.statements, [('DELETE', (5, 2))])
+        stats = self.writeBehind.getStats()
+        self.assertEqual((stats["pending"], stats["superseded"]), (0, 1))
+
+    def test_only_the_newest_retry_for_a_row_is_kept(self):
+        self.db.down = True
+        for op in ('INSERT', 'DELETE', 'INSERT'):
+            self.writeBehind.add('t_role_memberof', op, (5, 2))
+            self.assertFalse(self.writeBehind.flush())
+        self.db.down = False
+        self.assertTrue(self.writeBehind.flush())
+        self.assertEqual(self.db.statements, [('INSERT', (5, 2))])
+
+    def test_pending_is_capped(self):
+        self.db.down = True
+        self.add([(i, 2) for i in range(50)])
+        stats = self.writeBehind.getStats()
+        self.assertLessEqual(stats["pending"], 20)
+        self.assertEqual(stats["pending"] + stats["dropped"], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()